@@ -1,15 +1,16 @@
 from nltk.corpus import stopwords
 import nltk
 import warnings
-from time import time
 from Classes.HCSOs import HCSOs
 from Classes.Results import Results
 from Classes.GloVe import GloVe
 from Classes.Doc2Vec import Doc2Vec
 from Classes.SBERT import SBERT
-import pandas as pd
+from Classes.Corpus import Corpus
+from Classes.TrainingScheduler import TrainingScheduler, Task
+from Classes.StageMetrics import enable
+from nltk.tokenize import word_tokenize
 import os
-from waiter import get_time
 
 try:
     stop_words = set(stopwords.words('english'))
@@ -17,6 +18,44 @@ except:
     nltk.download('stopwords')
     stop_words = set(stopwords.words('english'))
 
+## Rough peak memory of each SBERT model while encoding, in GB
+SBERT_MEMORY_GB = {'bert-base-nli-mean-tokens': 2, 'all-mpnet-base-v2': 2, 'all-MiniLM-L6-v2': 1, 'gtr-t5-xxl': 24}
+
+
+def train_glove(glove_model, dimensions, stop_words, directory, threads = 1):
+    '''
+    Fits one GloVe model on the prepared co-occurrence matrix and saves its document embeddings
+    '''
+    glove_model.co_matrix = glove_model.co_matrix.toarray() ## Kept sparse until now so it is cheap to send to the worker
+    with warnings.catch_warnings(): ## Pandas hates append now, this just catches the warning
+        warnings.simplefilter(action='ignore', category=UserWarning)
+        glove_model.run_GloVe(dimensions=dimensions, iterations = 3000)
+    glove_model.document_encode()
+    glove_model.save_docs(directory = directory, stop_words = stop_words)
+    return int(dimensions)
+
+
+def train_doc2vec(doc2vec_model, dimensions, stop_words, corpus, directory, threads = 1):
+    '''
+    Trains one Doc2Vec model, using threads gensim workers, and saves its document embeddings
+    '''
+    doc2vec_model.tag_docs(stop_words = stop_words, corpus = corpus)
+    doc2vec_model.document_encode(dimensions = dimensions, iterations = 3000, workers = threads)
+    doc2vec_model.save_docs(directory = directory, stop_words = stop_words)
+    return int(dimensions)
+
+
+def train_sbert(sbert_model, model, stop_words, tag, directory, cache_dir, threads = 1):
+    '''
+    Encodes the documents with one SBERT model, using threads torch threads, and saves the embeddings
+    '''
+    import torch
+    torch.set_num_threads(threads)
+    sbert_model.document_encode(model = model, stop_words = stop_words, cache_dir = cache_dir)
+    sbert_model.save_docs(directory = directory, tag = tag)
+    return sbert_model.dimensions
+
+
 if __name__ == "__main__":
 
     ## Locate the directory that data will be stored in, used for all loading and saving later on
@@ -26,9 +65,10 @@ if __name__ == "__main__":
     db_path = f"{data_dir}/results.sqlite"
     results = Results(db_path)
     results.add_model_tab()
+    enable(db_path, busy_timeout = 30000) ## Record the time and memory of each measured stage in the stage_metrics table, including those run by the scheduler's workers, which wait for each other's writes
 
-    raw_data = HCSOs(data_dir, version_name = None) ## If the file ending in _articles.csv is in the data directory, the HCSO's class will find it without being told
-    raw_data.refine_data() ## Run the function to restructure the data to be more convenient for use
+    raw_data = HCSOs(data_dir, version_name = None, snapshot_dir = f"{data_dir}/cache", refine_fast = True) ## If the file ending in _articles.csv is in the data directory, the HCSO's class will find it without being told
+    raw_data.refine_data(fast = True) ## Run the function to restructure the data to be more convenient for use
 
     try:
         stop_words = set(stopwords.words('english'))
@@ -36,87 +76,56 @@ if __name__ == "__main__":
         nltk.download('stopwords')
         stop_words = set(stopwords.words('english'))
 
-    times_df = pd.DataFrame()
+    ## Preprocess once, keeping both the stop words in and out text, and tokenise once for all the models
+    raw_data.preprocess(stop_words=stop_words, fast = True, n_jobs = -1, cache_dir = f"{data_dir}/cache")
+    corpus = Corpus(raw_data.processed, stop_words)
+    glove_corpus = Corpus(raw_data.processed, stop_words, tokeniser = word_tokenize) ## GloVe has always used nltk's tokeniser
+
+    ## Every configuration is its own task. The SBERT models go first as they take longest, and never overlap with each other
+    ## as the larger ones can use most of the memory. GloVe and Doc2Vec fill in the spare cores around them
+    embeddings_dir = f"{data_dir}/Embeddings"
+    cpus = os.cpu_count() or 1
+    scheduler = TrainingScheduler(threads = cpus)
     for b in [False, True]:
-        if b:
-            raw_data.preprocess()
-            stops = "In"
-            tag = ""
-        else:
-            raw_data.preprocess(stop_words=stop_words)
-            stops = "Out"
-            tag = "_b"
-        
-        print(f"Modelling GloVe with stop words {stops}")
-        glove_model = GloVe(raw_data.processed)
-        glove_model.preprocess(stop_words = b)
-        glove_model.make_co_matrix()
-        for i in ['025','050','075','100']:
-            
-            if os.path.exists(f"{data_dir}/Embeddings/GloVe - {i} dimensions{tag}.joblib"):
-                print(f"Skipping GloVe - {i} dimensions{tag}")
+        stops = "In" if b else "Out"
+        tag = "" if b else "_b"
+        sbert_model = SBERT(raw_data.processed)
+        for i in ['bert-base-nli-mean-tokens','all-mpnet-base-v2','all-MiniLM-L6-v2','gtr-t5-xxl']:
+            if os.path.exists(f"{embeddings_dir}/SBERT - {i}{tag}.joblib"):
+                print(f"Skipping SBERT - {i}{tag}")
                 continue
-            print(f"GloVe {i} dimesions")
-            print(f"Starting at: {get_time()}")
-            start = time()
-            with warnings.catch_warnings(): ## Pandas hates append now, this just catches the warning
-                warnings.simplefilter(action='ignore', category=UserWarning)
-                glove_model.run_GloVe(dimensions=i, iterations = 3000)
-            glove_model.document_encode()
-            glove_model.save_docs(directory = f"{data_dir}/Embeddings", stop_words = b)
-            row = {
-                "model": "GloVe",
-                "type": i,
-                "stop_words": stops,
-                "dimensions": int(i),
-                "time": time() - start
-            }
-            results.add_training_time(row)
-            print("\n")
-
-        print(f"Modelling Doc2Vec with stop words {stops}")
+            scheduler.add(Task(f"SBERT - {i}{tag}", train_sbert, (sbert_model, i, b, tag, embeddings_dir, f"{embeddings_dir}/cache"),
+                               threads = max(1, cpus // 2), memory_gb = SBERT_MEMORY_GB.get(i, 4), exclusive = "SBERT",
+                               info = {"model": "SBERT", "type": i, "stop_words": stops}))
+
+    for b in [False, True]:
+        stops = "In" if b else "Out"
+        tag = "" if b else "_b"
+        glove_dims = [i for i in ['025','050','075','100'] if not os.path.exists(f"{embeddings_dir}/GloVe - {i} dimensions{tag}.joblib")]
+        if glove_dims:
+            print(f"Counting GloVe co-occurrences with stop words {stops}")
+            glove_model = GloVe(raw_data.processed)
+            glove_model.preprocess(stop_words = b, corpus = glove_corpus)
+            glove_model.make_co_matrix(vectorised = True, dense = False)
+            ## The dense matrix, plus mittens' weights and log counts of the same size
+            glove_memory = 3 * len(glove_model.vocab) ** 2 * 8 / 1e9
+        for i in glove_dims:
+            scheduler.add(Task(f"GloVe - {i} dimensions{tag}", train_glove, (glove_model, i, b, embeddings_dir), threads = 2,
+                               memory_gb = glove_memory, info = {"model": "GloVe", "type": i, "stop_words": stops}))
+
         doc2vec_model = Doc2Vec(raw_data.processed)
-        doc2vec_model.tag_docs(stop_words = b)
         for i in ['025','050','075','100']:
-
-            if os.path.exists(f"{data_dir}/Embeddings/Doc2Vec - {i} dimensions{tag}.joblib"):
+            if os.path.exists(f"{embeddings_dir}/Doc2Vec - {i} dimensions{tag}.joblib"):
                 print(f"Skipping Doc2Vec - {i} dimensions{tag}")
                 continue
-            print(f"Doc2Vec {i} dimesions")
-            print(f"Starting at: {get_time()}")
-
-            start = time()
-            doc2vec_model.document_encode(dimensions=(i), iterations = 3000)
-            doc2vec_model.save_docs(directory = f"{data_dir}/Embeddings", stop_words = b)
-            row = {
-                "model": "Doc2Vec",
-                "type": i,
-                "stop_words": stops,
-                "dimensions": int(i),
-                "time": time() - start
-            }
-            results.add_training_time(row)
-            print("\n")
-        
-        print(f"Modelling SBERT with stop words {stops}")
-        SBERT_model = SBERT(raw_data.processed)
-        for i in ['bert-base-nli-mean-tokens','all-mpnet-base-v2','all-MiniLM-L6-v2','gtr-t5-xxl']:
+            scheduler.add(Task(f"Doc2Vec - {i} dimensions{tag}", train_doc2vec, (doc2vec_model, i, b, corpus, embeddings_dir), threads = 3,
+                               memory_gb = 1, info = {"model": "Doc2Vec", "type": i, "stop_words": stops}))
 
-            if os.path.exists(f"{data_dir}/Embeddings/SBERT - {i}{tag}.joblib"):
-                print(f"Skipping SBERT - {i}{tag}")
-                continue
-            print(f"SBERT {i}")            
-            print(f"Starting at: {get_time()}")
-
-            start = time()
-            SBERT_model.document_encode(model = i, stop_words = b)
-            SBERT_model.save_docs(directory = f"{data_dir}/Embeddings", tag = tag)
-            row = {
-                "model": "SBERT",
-                "type": i,
-                "stop_words": stops,
-                "dimensions": SBERT_model.dimensions,
-                "time": time() - start
-            }
-            results.add_training_time(row)
-            print("\n")
\ No newline at end of file
+    def record_time(task, dimensions, started, finished, seconds):
+        ## Written as each job finishes so a crash part way through keeps the times of everything already done
+        row = dict(task.info, dimensions = dimensions, time = seconds, started = started, finished = finished)
+        results.add_training_time(row)
+
+    failed = scheduler.run(record_time)
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
@@ -1,64 +1,170 @@
-from Classes.Results import Results
 from Classes.HCSOs import HCSOs
-from Classes.Embeddings import Embeddings
+from Classes.Embeddings import Embeddings, list_embedding_files
+from Classes.DistanceSketch import DistanceSketch
+from Classes.StageMetrics import measure, enable
 import os
-from sklearn.metrics.pairwise import euclidean_distances
+from collections import namedtuple
+from scipy.spatial.distance import cdist, pdist
 from waiter import get_time
 import joblib
+import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
-def sim_by_group_full(grouping, embeddings, articles):
-    results = []
+## The two outputs of the grouped distance functions, so group_extremes can tell them apart by type
+GroupDistances = namedtuple("GroupDistances", ["groups", "offsets", "distances"])
+GroupSketches = namedtuple("GroupSketches", ["groups", "sketches"])
 
-    for v in articles[grouping].unique():
-        version = articles.query(f"{grouping} == {v}")
+def _sort_groups(grouping, articles):
+    '''
+    The distinct texts of each group sorted together with one stable argsort. Returns the group ids, the sorted text_index and the
+    starts array, so that the texts of groups[g] are text_index[starts[g]:starts[g + 1]] in their original order
+    '''
+    rows = articles.drop_duplicates(subset = [grouping, "text_index"])
+    codes, groups = pd.factorize(rows[grouping])
+    grouped = codes >= 0
+    ## Stable sort keeps the articles in their original order within each group
+    order = np.argsort(codes[grouped], kind = "stable")
+    text_index = rows["text_index"].to_numpy()[grouped][order]
+    starts = np.concatenate([[0], np.cumsum(np.bincount(codes[grouped], minlength = len(groups)))])
+    return np.asarray(groups), text_index, starts
 
-        version = version.drop_duplicates(subset = "text_index")
-        
-        similarities = []
+def _pairwise_exact(vectors, block_size = 8192):
+    '''
+    Distances between every pair of rows (i < j, in row order) worked out the way sklearn's euclidean_distances does for a single pair,
+    so the values are bit for bit the same as calling it on one pair at a time. float32 vectors are upcast to float64 and the result cast back, as sklearn does
+    '''
+    upcast = vectors.dtype == np.float32
+    vectors = np.asarray(vectors, dtype = np.float64)
+    norms = np.einsum("ij,ij->i", vectors, vectors)
+    first, second = np.triu_indices(len(vectors), k = 1)
+    output = np.empty(len(first), dtype = np.float32 if upcast else np.float64)
+    for start in range(0, len(first), block_size):
+        i, j = first[start:start + block_size], second[start:start + block_size]
+        ## A stack of 1 x 1 products gives the same rounding as the single pair dot product
+        d = -2 * (vectors[i][:, np.newaxis, :] @ vectors[j][:, :, np.newaxis]).ravel()
+        d += norms[i]
+        d += norms[j]
+        output[start:start + block_size] = d
+    np.maximum(output, 0, out = output)
+    return np.sqrt(output, out = output)
+
+@measure("2a.group_distances", items = lambda grouping, embeddings, articles, *args, **kwargs: len(articles), info = lambda grouping, *args, **kwargs: grouping)
+def group_distances(grouping, embeddings, articles, dtype = np.float32, exact = False):
+    '''
+    Calculates the euclidean distance between every pair of distinct texts within each group.
 
-        for _i, article_i in enumerate(version.to_numpy()):
-            text_index_i = article_i[9]
-            vec_i = embeddings[text_index_i].reshape(1, -1)
+    Rows are sorted by group and each group gets a single pdist call. Returns a GroupDistances of the group ids, an offsets array and one flat array of condensed distances, 
+    so that the distances for groups[g] are distances[offsets[g]:offsets[g + 1]], in the same pair order as the nested loop this replaced.
+    exact = True uses _pairwise_exact instead of pdist, to reproduce the original euclidean_distances values exactly.
+    '''
+    embeddings = np.vstack(embeddings) if isinstance(embeddings, list) else embeddings
+    groups, text_index, starts = _sort_groups(grouping, articles)
+    sizes = np.diff(starts)
+    offsets = np.concatenate([[0], np.cumsum(sizes * (sizes - 1) // 2)])
 
-            for _ii, article_ii in enumerate(version.to_numpy()):
-                if _ii <= _i:  # ensure that _ii is always greater than _i, so we don't compare the same pairs twice
-                    continue
-                text_index_ii = article_ii[9]
-                vec_ii = embeddings[text_index_ii].reshape(1, -1)
+    distances = np.empty(offsets[-1], dtype = dtype)
+    for g in range(len(groups)):
+        if sizes[g] > 1:
+            vectors = embeddings[text_index[starts[g]:starts[g + 1]]]
+            distances[offsets[g]:offsets[g + 1]] = _pairwise_exact(vectors) if exact else pdist(vectors)
+    return GroupDistances(groups, offsets, distances)
 
-                e = euclidean_distances(vec_i, vec_ii)[0][0]
-                similarities.append(e)
+@measure("2a.group_sketches", items = lambda grouping, embeddings, articles, *args, **kwargs: len(articles), info = lambda grouping, *args, **kwargs: grouping)
+def group_sketches(grouping, embeddings, articles, block_size = 1024, n_bins = 1024, base_width = 0.01):
+    '''
+    Streams the within group distances into a DistanceSketch per group rather than keeping them.
 
+    Each group's distances are worked out in block_size by block_size tiles, so at most block_size ** 2 distances are held at once whatever the group size.
+    Returns a GroupSketches of the group ids and a list of sketches
+    '''
+    embeddings = np.vstack(embeddings) if isinstance(embeddings, list) else embeddings
+    groups, text_index, starts = _sort_groups(grouping, articles)
+    sketches = []
+    for g in range(len(groups)):
+        vectors = embeddings[text_index[starts[g]:starts[g + 1]]]
+        sketch = DistanceSketch(n_bins = n_bins, base_width = base_width)
+        for row in range(0, len(vectors), block_size):
+            for column in range(row, len(vectors), block_size):
+                block = cdist(vectors[row:row + block_size], vectors[column:column + block_size])
+                if column == row:
+                    ## Only the pairs above the diagonal, so each pair is counted once
+                    block = block[np.triu_indices(block.shape[0], k = 1, m = block.shape[1])]
+                sketch.update(block)
+        sketches.append(sketch)
+    return GroupSketches(groups, sketches)
+
+def merge_sketches(sketches):
+    '''
+    Combines the group sketches into a single sketch for the whole category
+    '''
+    output = DistanceSketch(n_bins = sketches[0].n_bins, base_width = sketches[0].base_width)
+    for sketch in sketches:
+        output.merge(sketch)
+    return output
+
+def sim_by_group_full(grouping, embeddings, articles):
+    '''
+    Within group distances in the original list of dictionaries format, built from group_distances.
+    The distances are worked out exactly as before and kept in float64, so they are identical to the old euclidean_distances output
+    '''
+    groups, offsets, distances = group_distances(grouping, embeddings, articles, dtype = np.float64, exact = True)
+    results = []
+    for g, v in enumerate(groups):
         # Storing all values for each group
         group_result = {
             grouping: v,
-            "similarity": similarities
+            "similarity": distances[offsets[g]:offsets[g + 1]].tolist()
         }
         results.append(group_result)
 
     return results
 
+def group_extremes(results, grouping):
+    '''
+    Returns the group ids and the smallest and largest distance in each group, nan for groups without any pairs.
+
+    results can be the output of group_distances, group_sketches or the list format from sim_by_group_full
+    '''
+    if isinstance(results, GroupSketches):
+        groups, sketches = results
+        mins = np.array([s.min if s.count else np.nan for s in sketches])
+        maxs = np.array([s.max if s.count else np.nan for s in sketches])
+        return np.asarray(groups), mins, maxs
+    if isinstance(results, GroupDistances):
+        groups, offsets, distances = results
+        nonempty = np.diff(offsets) > 0
+        mins = np.full(len(groups), np.nan)
+        maxs = np.full(len(groups), np.nan)
+        if nonempty.any():
+            ## Empty groups have no length, so the starts of the non-empty groups mark out every group's distances
+            mins[nonempty] = np.minimum.reduceat(distances, offsets[:-1][nonempty])
+            maxs[nonempty] = np.maximum.reduceat(distances, offsets[:-1][nonempty])
+        return np.asarray(groups), mins, maxs
+    if not isinstance(results, list):
+        raise TypeError(f"Expected GroupDistances, GroupSketches or a list of dictionaries, not {type(results).__name__}")
+    groups = np.array([r[grouping] for r in results])
+    mins = np.array([min(r["similarity"]) if len(r["similarity"]) else np.nan for r in results])
+    maxs = np.array([max(r["similarity"]) if len(r["similarity"]) else np.nan for r in results])
+    return groups, mins, maxs
+
 def find_assumption_failures(root_results, version_results):
-    failures = []
-    total = 0
-    # Determine the least similar cosine
-    for root in root_results:
-        if len(root["similarity"]) == 0:
-            continue
-        least_similar = max(root["similarity"])
-
-        for version in version_results:
-            if min(version["similarity"]) < least_similar:
-                failure = {
-                    "root": root["root_num"],
-                    "version": version["version_num"]
-                }
-                failures.append(failure)
-            total += 1
-    return failures, total
+    '''
+    Counts, for each root, the versions whose most similar pair is closer than that root's least similar pair.
+
+    Returns the root ids, the failure count and failure rate for each root, and the total number of root/version comparisons. Roots without any pairs are left out, as before.
+    '''
+    roots, _, root_max = group_extremes(root_results, "root_num")
+    _, version_min, _ = group_extremes(version_results, "version_num")
+    has_pairs = ~np.isnan(root_max)
+    roots, root_max = roots[has_pairs], root_max[has_pairs]
+    ## The number of version minimums below each root's maximum comes straight from a search of the sorted minimums
+    sorted_min = np.sort(version_min[~np.isnan(version_min)])
+    failure_counts = np.searchsorted(sorted_min, root_max, side = "left")
+    failure_rates = failure_counts / max(len(version_min), 1)
+    total = len(roots) * len(version_min)
+    return roots, failure_counts, failure_rates, total
 
 def prepare_data_for_boxplot(results, category_name):
     similarities = []
@@ -70,7 +176,7 @@ def prepare_data_for_boxplot(results, category_name):
     
     return pd.DataFrame({
         "Category": categories,
-        "similarity": similarities
+        "Euclidean Distance": similarities
     })
 
 if __name__ == "__main__":
@@ -80,58 +186,77 @@ if __name__ == "__main__":
     ## Define the path to the database of results
     db_path = f"{data_dir}/results.sqlite"
     ## List out the files in the embedding folder
-    embedding_files = [i for i in os.listdir(f"{data_dir}/Embeddings")]
+    embedding_files = list_embedding_files(f"{data_dir}/Embeddings")
+    ## How the within group distances are kept:
+    ##   True  - streamed into a fixed memory DistanceSketch per group and saved as "<embedding> sketches.joblib". The failure rates are
+    ##           exact, but the boxplots are drawn from histogram estimates of the quartiles and without outliers
+    ##   False - every distance is kept, as originally, and saved as "<embedding> versions.joblib" and "<embedding> roots.joblib". 
+    ##           Needs memory for every pair in the largest groups, but gives the exact seaborn boxplots
+    streaming = True
 
-    ## Initiate the Results class object that points to and interacts with the results database
-    results = Results(db_path)
-    results.drop_tab("kmeans_times")
-    results.create_res_tab("kmeans_times")
+    enable(db_path) ## Record the time and memory of each measured stage in the stage_metrics table
     ## Initiate the HCSOs object that holds and manipulates the Standing Orders original data file
-    raw_data = HCSOs(data_dir, "parlrules_ukhoc_3.0.1_articles.csv")
-    raw_data.refine_data()
+    raw_data = HCSOs(data_dir, "parlrules_ukhoc_3.0.1_articles.csv", snapshot_dir = f"{data_dir}/cache", refine_fast = True)
+    raw_data.refine_data(fast = True)
     raw_data.add_version_id()
     results_dict = {}
     for i in embedding_files:
         
-        ## Ignore filees that don't have the joblib extension used to save the embeddings
-        if not i.endswith('.joblib'):
-            continue
-        m = i.replace(".joblib","")
+        m = i.replace(".joblib","").replace(".npy","")
         print(m)
         print(get_time())
         ## Initial set up for the embeddings
         emb_path = f"{data_dir}/Embeddings/{i}" ## Place the embedding file is located
         embeddings = Embeddings(emb_path, i) ## Initiate document, the Embeddings object holding the embeddings
         embeddings.load() ## Loads the embeddings. The embeddings are a list of numpy arrays
-        embeddings.scale() ## Scales the loaded embeddings 
-
-        if not os.path.exists(f"{data_dir}/sims/{m} versions.joblib"):
-            version_results = sim_by_group_full("version_num", embeddings.data, raw_data.data)
-            with open(f"{data_dir}/sims/{m} versions.joblib", "wb") as f:
-                joblib.dump(version_results,f)
-        else: 
-            with open(f"{data_dir}/sims/{m} versions.joblib", "rb") as f:
-                version_results = joblib.load(f)
-        if not os.path.exists(f"{data_dir}/sims/{m} roots.joblib"):
-            root_results = sim_by_group_full("root_num", embeddings.data, raw_data.data)
-            with open(f"{data_dir}/sims/{m} roots.joblib", "wb") as f:
-                joblib.dump(root_results,f)
+        embeddings.scale(cache = True) ## Scales the loaded embeddings, reusing the saved scaler after the first run 
+
+        if streaming:
+            ## Distances go straight into fixed size sketches, which are all that is saved and used below
+            sketch_path = f"{data_dir}/sims/{m} sketches.joblib"
+            if not os.path.exists(sketch_path):
+                version_results = group_sketches("version_num", embeddings.data, raw_data.data)
+                root_results = group_sketches("root_num", embeddings.data, raw_data.data)
+                with open(sketch_path, "wb") as f:
+                    joblib.dump({"versions": version_results, "roots": root_results}, f)
+            else:
+                with open(sketch_path, "rb") as f:
+                    sketches = joblib.load(f)
+                version_results, root_results = GroupSketches(*sketches["versions"]), GroupSketches(*sketches["roots"])
         else:
-            with open(f"{data_dir}/sims/{m} roots.joblib", "rb") as f:
-                root_results = joblib.load(f)
+            if not os.path.exists(f"{data_dir}/sims/{m} versions.joblib"):
+                version_results = sim_by_group_full("version_num", embeddings.data, raw_data.data)
+                with open(f"{data_dir}/sims/{m} versions.joblib", "wb") as f:
+                    joblib.dump(version_results,f)
+            else: 
+                with open(f"{data_dir}/sims/{m} versions.joblib", "rb") as f:
+                    version_results = joblib.load(f)
+            if not os.path.exists(f"{data_dir}/sims/{m} roots.joblib"):
+                root_results = sim_by_group_full("root_num", embeddings.data, raw_data.data)
+                with open(f"{data_dir}/sims/{m} roots.joblib", "wb") as f:
+                    joblib.dump(root_results,f)
+            else:
+                with open(f"{data_dir}/sims/{m} roots.joblib", "rb") as f:
+                    root_results = joblib.load(f)
 
-        failures, total = find_assumption_failures(root_results, version_results)
+        _, failure_counts, _, total = find_assumption_failures(root_results, version_results)
        
-        results_dict[m] = len(failures)/total
-
-        root_df = prepare_data_for_boxplot(root_results, "Root")
-        version_df = prepare_data_for_boxplot(version_results, "Version")
-        df = pd.concat([root_df, version_df])
+        results_dict[m] = failure_counts.sum()/total
 
         sns.set_context("talk")
         # Boxplot for Euclidean Distance
         plt.figure(figsize=(10, 6))
-        ax = sns.boxplot(x= "Category", y="Euclidean Distance", data=df)
+        if streaming:
+            ## The box statistics come from the category sketches rather than every individual distance
+            stats = [merge_sketches(root_results.sketches).box_stats("Root"), merge_sketches(version_results.sketches).box_stats("Version")]
+            ax = plt.gca()
+            ax.bxp(stats, showfliers = False)
+            ax.set_ylabel("Euclidean Distance")
+        else:
+            root_df = prepare_data_for_boxplot(root_results, "Root")
+            version_df = prepare_data_for_boxplot(version_results, "Version")
+            df = pd.concat([root_df, version_df])
+            ax = sns.boxplot(x= "Category", y="Euclidean Distance", data=df)
         ax.set_xlabel("")
         #plt.title("Distribution of Euclidean Distance for Roots vs. Versions")
         plt.savefig(f"{data_dir}/Graphs/Euclidean Distance {m}.png")
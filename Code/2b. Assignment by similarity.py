@@ -1,13 +1,13 @@
 from match_articles import match_articles, match_rate
-import os
+from Classes.Embeddings import list_embedding_files
+from Classes.StageMetrics import enable
 import pandas as pd
 
 if __name__ == "__main__":
+    enable("Data/results.sqlite") ## Record the time and memory of each measured stage in the stage_metrics table
     results = []
-    for i in os.listdir(f"data/Embeddings"):
-        if not i.endswith(".joblib"):
-            continue
-        mod = i.replace(".joblib","")
+    for i in list_embedding_files(f"data/Embeddings"):
+        mod = i.replace(".joblib","").replace(".npy","")
         if mod.endswith("_b"):
             stopwords = "Out"
             mod = mod.replace("_b","")
@@ -5,15 +5,20 @@ It begins by defining all relevant classes and functions, scroll to the bottom f
 '''
 import os
 import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from time import time
 
+import numpy as np
 import pandas as pd
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from threadpoolctl import threadpool_limits
 from tqdm import tqdm
 
-from Classes.Embeddings import Embeddings
+from Classes.ConfusionMatrix import ConfusionMatrix
+from Classes.Embeddings import Embeddings, list_embedding_files
 from Classes.HCSOs import HCSOs
 from Classes.Results import Results
+from Classes.StageMetrics import measure, enable
 
 
 
@@ -21,26 +26,206 @@ def expand_embeddings(input_embeddings, input_df):
     '''
     Used to take the embeddings output by the models for each unique text and expand them to match the order of texts in the full data set
 
-    embeddings is the list of numpy arrays holding the document embeddings
+    embeddings is the array (or list of numpy arrays) holding the document embeddings, one row per text_index
 
-    input_df is 
+    input_df is the full data set, only its text_index column is used. Returns a single array with a row for each article
     '''
-    df = input_df.copy()
-    embeddings_df = pd.DataFrame(input_embeddings)
-    embeddings_df["text_index"] = [index for index, _ in enumerate(embeddings_df.to_numpy())]
-    merged_df = df.merge(embeddings_df, on='text_index', how='left')
-    output_embeddings = [row.to_numpy() for _, row in merged_df.iloc[:,input_df.shape[1]:].iterrows()]
-    assert(len(output_embeddings[0]) == len(input_embeddings[0]))
-    return output_embeddings
+    input_embeddings = np.vstack(input_embeddings) if isinstance(input_embeddings, list) else np.asarray(input_embeddings)
+    return input_embeddings[input_df["text_index"].to_numpy()]
 
-def time_kmeans(results_dict, kmeans_obj, document, embeddings):
+def time_kmeans(results_dict, kmeans_obj, document, embeddings, text_index = None):
+    '''
+    Fits kmeans_obj to the embeddings and stores the labels in results_dict, returning the time taken.
+
+    If text_index is given, embeddings should be the unique embeddings and the fit is weighted by how often each text appears in text_index.
+    This has the same objective as clustering the expanded embeddings, and the labels are mapped back so there is still one per row of text_index
+    '''
     with warnings.catch_warnings(): ## Ignore the warning about memory leaks. It doesn't cause a problem on my machine but for anyone else running it, get rid of the warning filter to see the warning if it starts causing a memory leak
         start = time()
         warnings.simplefilter(action='ignore', category=UserWarning) 
-        kmeans_obj.fit(embeddings)
-    results_dict[f"{document.model}-{document.type}"] = kmeans_obj.labels_
+        if text_index is None:
+            kmeans_obj.fit(embeddings)
+            labels = kmeans_obj.labels_
+        else:
+            counts = np.bincount(text_index, minlength = len(embeddings))
+            kmeans_obj.fit(embeddings, sample_weight = counts)
+            labels = kmeans_obj.labels_[text_index]
+    results_dict[f"{document.model}-{document.type}"] = labels
     return time() - start
 
+STRATEGIES = ["lloyd", "elkan", "minibatch", "fast", "warm"]
+
+def make_kmeans(strategy = "lloyd", n_clusters = 323, n_init = 25, init = None, random_state = 42):
+    '''
+    Returns the clustering object for a strategy. 
+    
+    lloyd is the original 25 init KMeans, elkan swaps in Elkan's algorithm, minibatch uses MiniBatchKMeans, fast cuts KMeans down to 3 k-means++ inits,
+    and warm starts a single run from the centroids in init, falling back to fast if there are none
+    '''
+    if strategy == "lloyd":
+        return KMeans(n_clusters = n_clusters, n_init = n_init, random_state = random_state)
+    if strategy == "elkan":
+        return KMeans(n_clusters = n_clusters, n_init = n_init, algorithm = "elkan", random_state = random_state)
+    if strategy == "minibatch":
+        return MiniBatchKMeans(n_clusters = n_clusters, n_init = 3, batch_size = 4096, random_state = random_state)
+    if strategy == "fast" or (strategy == "warm" and init is None):
+        return KMeans(n_clusters = n_clusters, n_init = 3, init = "k-means++", random_state = random_state)
+    if strategy == "warm":
+        return KMeans(n_clusters = n_clusters, n_init = 1, init = init, random_state = random_state)
+    raise ValueError(f"Unknown strategy: {strategy}")
+
+## The same experiment on the other stop word version of an embedding, a different embedding file with the same model and dimensions
+PAIRED_EXPERIMENTS = {"a": "c", "b": "d", "c": "a", "d": "b"}
+
+def find_warm_start(label_dir, column, experiment, dimensions, warm_source = None):
+    '''
+    Finds the centroids to warm start from, returning (centroids, source) or (None, None).
+
+    warm_source is the path of an earlier run's centroids to use. Without one, the paired experiment on the other stop word version of the embedding is used.
+    The job's own saved centroids are never used, as they are the converged answer the fit is meant to find
+    '''
+    own = f"{label_dir}/{column}_{experiment}_centroids.npy"
+    candidates = [warm_source] if warm_source else [f"{label_dir}/{column}_{PAIRED_EXPERIMENTS[experiment]}_centroids.npy"]
+    for path in candidates:
+        if os.path.exists(path) and os.path.abspath(path) != os.path.abspath(own):
+            centroids = np.load(path)
+            if centroids.shape[1] == dimensions:
+                return centroids, os.path.basename(path)
+    return None, None
+
+@measure("3a.fit_kmeans", info = lambda emb_path, name, experiment, *args, **kwargs: f"{name} {experiment}")
+def _fit_job(emb_path, name, experiment, text_index, label_dir, weighted, threads, strategy, n_clusters, n_init, warm_source = None):
+    '''
+    Loads the embeddings and fits the clustering for one job, returning the embeddings object, fitted clustering object, labels, time taken
+    and the centroids file a warm start began from (None if it didn't)
+    '''
+    embeddings = Embeddings(emb_path, name)
+    embeddings.load()
+    embeddings.scale(cache = True)
+    column = f"{embeddings.model}-{embeddings.type}"
+    init, source = find_warm_start(label_dir, column, experiment, embeddings.data.shape[1], warm_source) if strategy == "warm" else (None, None)
+    if init is not None and init.shape[0] != n_clusters:
+        init, source = None, None
+    kmeans = make_kmeans(strategy, n_clusters = n_clusters, n_init = n_init, init = init)
+    labels = {}
+    with threadpool_limits(limits = threads):
+        if experiment in ["a", "c"] and weighted:
+            ktime = time_kmeans(labels, kmeans, embeddings, embeddings.data, text_index = text_index)
+        elif experiment in ["a", "c"]:
+            ktime = time_kmeans(labels, kmeans, embeddings, expand_embeddings(embeddings.data, pd.DataFrame({"text_index": text_index})))
+        else:
+            ktime = time_kmeans(labels, kmeans, embeddings, embeddings.data)
+    return embeddings, kmeans, labels[column], ktime, source
+
+def run_job(emb_path, name, experiment, text_index, label_dir, weighted = False, threads = 1, strategy = "lloyd", n_clusters = 323, n_init = 25):
+    '''
+    Runs one (embedding file, experiment) k-means fit in a worker process and saves its labels and centroids to label_dir as soon as it finishes.
+
+    Experiments a and c cluster every article, b and d only the unique texts. threads caps the BLAS/OpenMP threads the fit can use, so several jobs can share the machine
+    '''
+    embeddings, kmeans, labels, ktime, _ = _fit_job(emb_path, name, experiment, text_index, label_dir, weighted, threads, strategy, n_clusters, n_init)
+    column = f"{embeddings.model}-{embeddings.type}"
+    np.save(f"{label_dir}/{column}_{experiment}.npy", labels)
+    np.save(f"{label_dir}/{column}_{experiment}_centroids.npy", kmeans.cluster_centers_)
+    return embeddings.model, embeddings.type, experiment, ktime
+
+def benchmark_job(emb_path, name, experiment, text_index, y_true, label_dir, strategy, weighted = False, threads = 1, n_clusters = 323, n_init = 25, warm_source = None):
+    '''
+    Fits one job with the given strategy and returns a kmeans_benchmark row with its fit time, inertia, accuracy against y_true and any warm start source
+    '''
+    embeddings, kmeans, labels, ktime, source = _fit_job(emb_path, name, experiment, text_index, label_dir, weighted, threads, strategy, n_clusters, n_init, warm_source)
+    cm = ConfusionMatrix(y_true = y_true, y_pred = labels, name = f"{embeddings.model}-{embeddings.type}_{experiment}_{strategy}")
+    return {
+        "model": embeddings.model,
+        "type": embeddings.type,
+        "experiment": experiment,
+        "strategy": strategy,
+        "time": ktime,
+        "inertia": float(kmeans.inertia_),
+        "accuracy": cm.accuracy(),
+        "warm_source": source
+    }
+
+def run_benchmark(jobs, strategies, results, id_all, id_unique, label_dir, processes = None, threads = 1, weighted = False, warm_source = None):
+    '''
+    Runs every job with every strategy and records the fit time, inertia and accuracy of each in the kmeans_benchmark table.
+
+    warm_source is passed on to find_warm_start for the warm strategy
+    '''
+    os.makedirs(label_dir, exist_ok = True)
+    results.create_benchmark_tab()
+    if not processes:
+        processes = max(1, (os.cpu_count() or 1) // threads)
+    text_index = id_all["text_index"].to_numpy()
+    prepare_scalers(jobs)
+    pb = tqdm(total = len(jobs) * len(strategies), desc = "Benchmarking")
+    with ProcessPoolExecutor(max_workers = processes) as pool:
+        futures = {}
+        for emb_path, name, experiment in jobs:
+            y_true = (id_all if experiment in ["a", "c"] else id_unique)["root_num"].to_numpy()
+            for strategy in strategies:
+                future = pool.submit(benchmark_job, emb_path, name, experiment, text_index, y_true, label_dir, strategy, weighted, threads, warm_source = warm_source)
+                futures[future] = (name, experiment, strategy)
+        for future in as_completed(futures):
+            try:
+                results.add_benchmark(future.result())
+            except Exception as e:
+                print(f"{futures[future]} failed: {e}")
+            pb.update(1)
+    pb.close()
+
+def prepare_scalers(jobs):
+    '''
+    Fits and saves the cached scaler for every embedding file in jobs, before any are sent to a pool where several jobs would share the file
+    '''
+    for emb_path in dict.fromkeys(emb_path for emb_path, _, _ in jobs):
+        Embeddings(emb_path, os.path.basename(emb_path)).prepare_scaler()
+
+def completed_jobs(results, label_dir):
+    '''
+    The (model, type, experiment) combinations that already have a time in kmeans_times and a saved label file
+    '''
+    done = set()
+    times = results.get_table("kmeans_times")
+    for _, row in times.iterrows():
+        for experiment in ["a", "b", "c", "d"]:
+            if pd.notna(row[experiment]) and os.path.exists(f"{label_dir}/{row['model']}-{row['type']}_{experiment}.npy"):
+                done.add((row["model"], row["type"], experiment))
+    return done
+
+@measure("3a.run_kmeans_jobs", items = lambda jobs, *args, **kwargs: len(jobs), info = lambda *args, strategy = "lloyd", **kwargs: strategy)
+def run_kmeans_jobs(jobs, results, text_index, label_dir, processes = None, threads = 1, weighted = False, strategy = "lloyd"):
+    '''
+    Sends every (embedding path, file name, experiment) job that isn't already done to a process pool, recording each time in kmeans_times as the job finishes.
+
+    A crash only loses the jobs that were still running, rerunning picks up from there
+    '''
+    os.makedirs(label_dir, exist_ok = True)
+    done = completed_jobs(results, label_dir)
+    pending = []
+    for emb_path, name, experiment in jobs:
+        embeddings = Embeddings(emb_path, name)
+        if (embeddings.model, embeddings.type, experiment) in done:
+            print(f"Skipping {embeddings.model}-{embeddings.type} experiment {experiment}")
+            continue
+        pending.append((emb_path, name, experiment))
+
+    if not processes:
+        processes = max(1, (os.cpu_count() or 1) // threads)
+    prepare_scalers(pending)
+    pb = tqdm(total = len(pending))
+    with ProcessPoolExecutor(max_workers = processes) as pool:
+        futures = {pool.submit(run_job, emb_path, name, experiment, text_index, label_dir, weighted, threads, strategy): (name, experiment) for emb_path, name, experiment in pending}
+        for future in as_completed(futures):
+            try:
+                model, model_type, experiment, ktime = future.result()
+                results.add_result("kmeans_times", model, model_type, experiment, ktime)
+                results.register_labels(model, model_type, experiment, f"{label_dir}/{model}-{model_type}_{experiment}.npy", len(text_index) if experiment in ["a", "c"] else len(np.unique(text_index)))
+            except Exception as e:
+                print(f"{futures[future]} failed: {e}")
+            pb.update(1)
+    pb.close()
+
 if __name__ == "__main__":
 
     ## Locate the directory that data will be stored in, used for all loading and saving later on
@@ -48,88 +233,64 @@ if __name__ == "__main__":
     ## Define the path to the database of results
     db_path = f"{data_dir}/results.sqlite"
     ## List out the files in the embedding folder
-    embedding_files = [i for i in os.listdir(f"{data_dir}/Embeddings")]
+    embedding_files = list_embedding_files(f"{data_dir}/Embeddings")
 
     ## Initiate the Results class object that points to and interacts with the results database
-    results = Results(db_path)
+    results = Results(db_path, wal = True, busy_timeout = 30000)
+    enable(db_path, busy_timeout = 30000) ## Record the time and memory of each measured stage in the stage_metrics table, the worker processes waiting for each other's writes
     #results.drop_tab("kmeans_times")
     results.create_res_tab("kmeans_times")
     ## Initiate the HCSOs object that holds and manipulates the Standing Orders original data file
-    raw_data = HCSOs(data_dir, "parlrules_ukhoc_3.0.1_articles.csv")
-    raw_data.refine_data() ## Run the function to restructure the data to be more convenient for use
+    raw_data = HCSOs(data_dir, "parlrules_ukhoc_3.0.1_articles.csv", snapshot_dir = f"{data_dir}/cache", refine_fast = True)
+    raw_data.refine_data(fast = True) ## Run the function to restructure the data to be more convenient for use
 
-    ## Initiate a kmeans object that will be used to fit every kmeans model
-    kmeans = KMeans(n_clusters = 323, n_init = 25, random_state = 42) 
+    ## Experiments a and c cluster the embeddings indexed out to one row per article, as originally. Set to True to instead fit the unique embeddings
+    ## weighted by how often each text appears, which has the same objective but doesn't give the same labels as the original runs
+    weighted = False
+    ## Each job's labels are saved here as soon as it finishes
+    label_dir = f"{data_dir}/clusters"
+    ## BLAS threads per job, the number of parallel jobs defaults to the cpu count divided by this
+    threads = 2
+    ## Clustering strategy for the main run, one of STRATEGIES. benchmark = True also times every strategy and records its inertia and accuracy
+    strategy = "lloyd"
+    benchmark = False
+    ## Centroids file from an earlier run for the warm strategy to start from. None uses the other stop word version of each embedding
+    warm_source = None
 
     ## Get the two different versions of the text index column
     id_unique =  raw_data.unique_text_ids().copy().reset_index().drop("index", axis = 1)
     id_all = raw_data.all_ids().copy()
 
-    ## Create dictionaries that will hold the results of each different kmeans configuration
-    results_dict_a = {} ## All articles, no stop word filter
-    results_dict_b = {} ## Unique articles, no stop word filter
-    results_dict_c = {} ## All articles, stop words filtered out
-    results_dict_d = {} ## Unique articles, stop words filtered out
-    ## Create a dataframe that run times will be held in
-    #times_df = pd.DataFrame(columns = ["model","type","a","b","c","d"])
-    ## Initiate a progress bar (4 experiments x 12 embedding models = 48 total loops)
-    pb = tqdm(total=48)
-
-    ## Main K means loop, iterates over the contents of the embedding folder 
+    ## Build the job list (4 experiments x 12 embedding models = 48 jobs). If stop words were not removed the experiments are a and b, otherwise c and d.
+    jobs = []
     for i in embedding_files:
-        
-        ## Ignore filees that don't have the joblib extension used to save the embeddings
-        if not i.endswith('.joblib'):
-            continue
-        
-        ## Initial set up for the embeddings
-        emb_path = f"{data_dir}/Embeddings/{i}" ## Place the embedding file is located
-        embeddings = Embeddings(emb_path, i) ## Initiate document, the Embeddings object holding the embeddings
-        embeddings.load() ## Loads the embeddings. The embeddings are a list of numpy arrays
-        embeddings.scale() ## Scales the loaded embeddings 
-
-        ## Define the two versions of the data to be used
-        data_short = embeddings.data ## Just unique embeddings
-        data_long = expand_embeddings(embeddings.data, raw_data.all_ids()) ## Embeddings expanded such that each of thee 37947 articles is represented 
-        ## Checks to see if the model being used was trained with or without stop words. If stop words were not removed, run the experiments with labels a and b, otherwise c and d.
-        if not embeddings.no_stop_words:
-
-            ## experiment_a
-            ktime = time_kmeans(results_dict_a, kmeans, embeddings, data_long)
-            try:
-                results.add_result("kmeans_times", embeddings.model, embeddings.type, "a", ktime)
-            except Exception as e:
-                print(e)
-            pb.update(1)
-
-            ## experiment_b
-            ktime = time_kmeans(results_dict_b, kmeans, embeddings, data_short)
-            try:
-                results.add_result("kmeans_times", embeddings.model, embeddings.type, "b", ktime)
-            except Exception as e:
-                print(e)
-            pb.update(1)
+        embeddings = Embeddings(f"{data_dir}/Embeddings/{i}", i)
+        for experiment in (["c", "d"] if embeddings.no_stop_words else ["a", "b"]):
+            jobs.append((f"{data_dir}/Embeddings/{i}", i, experiment))
 
-        else:
-
-            ## experiment_c
-            ktime = time_kmeans(results_dict_c, kmeans, embeddings, data_long)
-            try:
-                results.add_result("kmeans_times", embeddings.model, embeddings.type, "c", ktime)
-            except Exception as e:
-                print(e)
-            pb.update(1)
+    ## Save the true root numbers for each experiment, so 3b can bulk load them alongside the cluster labels
+    results.create_label_tab()
+    os.makedirs(label_dir, exist_ok = True)
+    for experiment, ids in [("a", id_all), ("b", id_unique), ("c", id_all), ("d", id_unique)]:
+        np.save(f"{label_dir}/root_num_{experiment}.npy", ids["root_num"].to_numpy())
+        results.register_labels("root_num", "", experiment, f"{label_dir}/root_num_{experiment}.npy", len(ids))
 
-            ## experiment_d
-            ktime = time_kmeans(results_dict_d, kmeans, embeddings, data_short)
-            try:
-                results.add_result("kmeans_times", embeddings.model, embeddings.type, "d", ktime)
-            except Exception as e:
-                print(e)
-            pb.update(1)
+    ## Main K means loop, runs every job that hasn't already been recorded
+    run_kmeans_jobs(jobs, results, id_all["text_index"].to_numpy(), label_dir, threads = threads, weighted = weighted, strategy = strategy)
+    if benchmark:
+        run_benchmark(jobs, STRATEGIES, results, id_all, id_unique, label_dir, threads = threads, weighted = weighted, warm_source = warm_source)
 
-    ## Close the progress bar
-    pb.close()
+    ## Collect the saved labels for each experiment
+    results_dict_a = {} ## All articles, no stop word filter
+    results_dict_b = {} ## Unique articles, no stop word filter
+    results_dict_c = {} ## All articles, stop words filtered out
+    results_dict_d = {} ## Unique articles, stop words filtered out
+    experiment_dicts = {"a": results_dict_a, "b": results_dict_b, "c": results_dict_c, "d": results_dict_d}
+    for emb_path, name, experiment in jobs:
+        embeddings = Embeddings(emb_path, name)
+        column = f"{embeddings.model}-{embeddings.type}"
+        if os.path.exists(f"{label_dir}/{column}_{experiment}.npy"):
+            experiment_dicts[experiment][column] = np.load(f"{label_dir}/{column}_{experiment}.npy")
 
     a = pd.DataFrame(results_dict_a)
     b = pd.DataFrame(results_dict_b)
@@ -141,4 +302,3 @@ if __name__ == "__main__":
         results.overwrite_table(pd.concat([id_unique,b], axis = 1),"clusters_b")
         results.overwrite_table(pd.concat([id_all,c], axis = 1),"clusters_c")
         results.overwrite_table(pd.concat([id_unique,d], axis = 1),"clusters_d")
-    
\ No newline at end of file
@@ -1,6 +1,7 @@
 from Classes.ConfusionMatrix import ConfusionMatrix
 from Classes.Results import Results
 import re
+import numpy as np
 from tqdm import tqdm
 
 if __name__ == "__main__":
@@ -9,22 +10,37 @@ if __name__ == "__main__":
 
     ## Define the path to the database of results
     db_path = f"{data_dir}/results.sqlite"
-    results = Results(db_path)
+    results = Results(db_path, wal = True, busy_timeout = 30000)
     results.create_res_tab("kmeans_accuracies")
+    ## The other clustering metrics each get a results table of their own
+    extra_metrics = ["ari", "nmi", "v_measure"]
+    for metric in extra_metrics:
+        results.create_res_tab(f"kmeans_{metric}")
+ 
+    results.create_label_tab()
  
     pb = tqdm(total = 48, desc = "Evaluating Cluster Accuracy")
     for i in ["a","b","c","d"]:
-        table = f"clusters_{i}"
-        y_true = [int(r[0]) for r in results.get_col("root_num", table)]
-        models = results.list_table_columns(table)    
-        for m in models[3:]:
-            m_name = re.search("^(.*?)(?=-)", m).group(0)
-            m_type = re.search("^.*?-(.*)", m).group(1)
-
-            y_pred = [int(r[0]) for r in results.get_col(f"`{m}`", table)]
+        ## Every run's labels for the experiment come back as one 2-D array from the label store
+        y_true, runs, labels = results.load_labels(i)
+        if y_true is None:
+            ## Fall back to the wide clusters tables if the labels haven't been registered
+            table = f"clusters_{i}"
+            y_true = [int(r[0]) for r in results.get_col("root_num", table)]
+            runs = []
+            rows = []
+            for m in results.list_table_columns(table)[3:]:
+                runs.append((re.search("^(.*?)(?=-)", m).group(0), re.search("^.*?-(.*)", m).group(1)))
+                rows.append([int(r[0]) for r in results.get_col(f"`{m}`", table)])
+            labels = np.array(rows, dtype = np.int64)
 
-            cm = ConfusionMatrix(y_true=y_true, y_pred=y_pred, name = f'{m}_{i}')
-            acc = cm.accuracy()
-           
-            results.add_result("kmeans_accuracies",m_name,m_type,i,acc)
-            pb.update(1)
+        ## All of an experiment's results are written in a single transaction
+        with results.batch():
+            for (m_name, m_type), y_pred in zip(runs, labels):
+                cm = ConfusionMatrix(y_true=y_true, y_pred=y_pred, name = f'{m_name}-{m_type}_{i}')
+                metrics = cm.metrics()
+               
+                results.add_result("kmeans_accuracies",m_name,m_type,i,metrics["accuracy"])
+                for metric in extra_metrics:
+                    results.add_result(f"kmeans_{metric}",m_name,m_type,i,float(metrics[metric]))
+                pb.update(1)
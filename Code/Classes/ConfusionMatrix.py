@@ -1,28 +1,82 @@
-from sklearn.metrics import confusion_matrix
 import matplotlib.pyplot as plt
 from scipy.optimize import linear_sum_assignment
+from scipy import sparse
 import numpy as np
 
 class ConfusionMatrix:
     def __init__(self, y_true, y_pred, name):
-        self.y_true = y_true
-        self.y_pred = y_pred
-        original_cm = confusion_matrix(y_true, y_pred)
+        self.y_true = np.asarray(y_true)
+        self.y_pred = np.asarray(y_pred)
+        # Build the true label x cluster contingency table in one pass
+        self.labels, true_idx = np.unique(self.y_true, return_inverse = True)
+        self.clusters, pred_idx = np.unique(self.y_pred, return_inverse = True)
+        self.contingency = sparse.coo_matrix((np.ones(len(true_idx), dtype = np.int64), (true_idx.ravel(), pred_idx.ravel())), shape = (len(self.labels), len(self.clusters))).tocsr()
+        original_cm = self.contingency.toarray()
         row_ind, col_ind = linear_sum_assignment(-original_cm)
-        # Using the outputs of linear_sum_assignment
-        self.adjusted_y_pred = np.empty_like(self.y_pred)
-        for cluster_idx, true_label_idx in enumerate(col_ind):
-            self.adjusted_y_pred[self.y_pred == cluster_idx] = true_label_idx
+        # Using the outputs of linear_sum_assignment, map each cluster to the true label it was matched with. Unmatched clusters get -1
+        lookup = np.full(len(self.clusters), -1, dtype = np.int64)
+        lookup[col_ind] = row_ind
+        self.cluster_to_label = lookup
+        self.matched = original_cm[row_ind, col_ind]
+        self.matched_rows = row_ind
+        self.adjusted_y_pred = np.where(lookup[pred_idx.ravel()] >= 0, self.labels[np.maximum(lookup[pred_idx.ravel()], 0)], -1)
 
-        self.cm = original_cm[row_ind[:, np.newaxis], col_ind]
+        # Reordered so matched labels and clusters sit on the diagonal, with any unmatched ones at the end
+        row_order = np.concatenate([row_ind, np.setdiff1d(np.arange(len(self.labels)), row_ind)])
+        col_order = np.concatenate([col_ind, np.setdiff1d(np.arange(len(self.clusters)), col_ind)])
+        self.cm = original_cm[row_order[:, np.newaxis], col_order[np.newaxis, :]]
         self.name = name
-    
+
     def accuracy(self):
         # Calculate accuracy
-        self.acc = np.diagonal(self.cm).sum() / self.cm.sum()
+        self.acc = self.matched.sum() / len(self.y_true)
         output = round(self.acc * 100, 2)
         return output
 
+    def root_recall(self):
+        '''
+        Share of each true label's articles that were put in the cluster matched to it, in the order of self.labels
+        '''
+        row_totals = np.asarray(self.contingency.sum(axis = 1)).ravel()
+        recall = np.zeros(len(self.labels))
+        recall[self.matched_rows] = self.matched / row_totals[self.matched_rows]
+        return recall
+
+    def metrics(self):
+        '''
+        Accuracy, adjusted Rand index, normalised mutual information, homogeneity, completeness and V-measure, all worked out from the contingency table
+        '''
+        n = len(self.y_true)
+        counts = self.contingency.data.astype(np.float64)
+        rows, cols = self.contingency.nonzero()
+        row_totals = np.asarray(self.contingency.sum(axis = 1)).ravel().astype(np.float64)
+        col_totals = np.asarray(self.contingency.sum(axis = 0)).ravel().astype(np.float64)
+
+        # Adjusted Rand index from the pair counts
+        pairs = lambda x: (x * (x - 1) / 2).sum()
+        sum_cells, sum_rows, sum_cols = pairs(counts), pairs(row_totals), pairs(col_totals)
+        expected = sum_rows * sum_cols / (n * (n - 1) / 2) if n > 1 else 0.0
+        maximum = (sum_rows + sum_cols) / 2
+        ari = 1.0 if maximum == expected else (sum_cells - expected) / (maximum - expected)
+
+        # Mutual information and entropies
+        mi = (counts / n * np.log(n * counts / (row_totals[rows] * col_totals[cols]))).sum()
+        entropy = lambda x: -(x / n * np.log(x / n)).sum()
+        h_true, h_pred = entropy(row_totals), entropy(col_totals)
+        homogeneity = mi / h_true if h_true else 1.0
+        completeness = mi / h_pred if h_pred else 1.0
+        v_measure = 2 * homogeneity * completeness / (homogeneity + completeness) if homogeneity + completeness else 0.0
+
+        return {
+            "accuracy": self.accuracy(),
+            "ari": ari,
+            "nmi": v_measure, ## With the arithmetic mean normalisation NMI and V-measure are the same thing
+            "homogeneity": homogeneity,
+            "completeness": completeness,
+            "v_measure": v_measure,
+            "root_recall": self.root_recall()
+        }
+
     def plot(self, directory, width = 5, height = 5, dpi = 100):
         path = f'{directory}/{self.name}.png'
         # Visualize the confusion matrix
@@ -33,4 +87,4 @@ class ConfusionMatrix:
         plt.xlabel("Predicted Label")
         plt.ylabel("True Label")
         plt.savefig(path, dpi = dpi)
-        plt.close()
\ No newline at end of file
+        plt.close()
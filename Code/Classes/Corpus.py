@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from Classes.StageMetrics import measure
+
+
+class Corpus():
+    '''
+    The preprocessed documents tokenised once, held as integer token ids so every model can share them.
+
+    tokens is a flat int32 array of vocab ids for every document one after the other, with document i running from offsets[i] to offsets[i + 1].
+    stop_mask marks the tokens that are stop words, so the stop words in and out versions of the corpus are both taken from the same tokens
+    '''
+    @measure("Corpus.build", items = lambda self, *args, **kwargs: len(self.tokens))
+    def __init__(self, input_df, stop_words = None, tokeniser = None, documents_col = "text_preprocessed"):
+        '''
+        input_df is HCSOs.processed, de-duplicated on text_index in the same way as the models.
+
+        tokeniser is any function from a string to a list of tokens and defaults to str.split, which makes the stop words out version exactly
+        the tokens of the text_no_stop column. With another tokeniser, such as nltk's word_tokenize, stop words are instead removed after tokenising
+        '''
+        data = input_df.drop_duplicates(subset = "text_index")
+        self.text_index = data["text_index"].to_numpy()
+        tokeniser = tokeniser if tokeniser else str.split
+
+        tqdm.pandas(desc = "Tokenising...")
+        token_lists = data[documents_col].progress_apply(tokeniser)
+        lengths = token_lists.str.len().to_numpy()
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        token_ids, vocab = pd.factorize(pd.Series([token for tokens in token_lists for token in tokens], dtype = object))
+        self.tokens = token_ids.astype(np.int32)
+        self.vocab = np.asarray(vocab, dtype = object)
+
+        stop_words = set(stop_words) if stop_words else set()
+        self.stop_vocab = np.array([word in stop_words for word in self.vocab], dtype = bool)
+        self.stop_mask = self.stop_vocab[self.tokens]
+        self._views = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def view(self, stop_words = True):
+        '''
+        Returns (tokens, lengths) for one version of the corpus. stop_words = True keeps the stop words, matching the models' own stop_words argument.
+
+        The stop words in version is the corpus arrays themselves, the stop words out version is worked out once and kept
+        '''
+        if stop_words:
+            return self.tokens, np.diff(self.offsets)
+        if False not in self._views:
+            keep = ~self.stop_mask
+            ## Number of kept tokens in each document, from the running total at each document boundary
+            kept = np.concatenate([[0], np.cumsum(keep)])[self.offsets]
+            self._views[False] = (self.tokens[keep], np.diff(kept))
+        return self._views[False]
+
+    def documents(self, stop_words = True):
+        '''
+        The documents as lists of token strings, for models that need words rather than ids
+        '''
+        tokens, lengths = self.view(stop_words)
+        words = self.vocab[tokens]
+        bounds = np.cumsum(lengths)[:-1]
+        return [doc.tolist() for doc in np.split(words, bounds)]
+
+    def check_alignment(self, input_df):
+        '''
+        Raises a ValueError if the documents of input_df, de-duplicated on text_index, aren't the corpus documents in the same order
+        '''
+        text_index = input_df.drop_duplicates(subset = "text_index")["text_index"].to_numpy()
+        if not np.array_equal(text_index, self.text_index):
+            raise ValueError("The corpus was built from different documents, or documents in a different order")
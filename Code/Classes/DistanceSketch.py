@@ -0,0 +1,109 @@
+import numpy as np
+
+
+class DistanceSketch():
+    '''
+    A fixed memory summary of a stream of non-negative distances: an equal width histogram plus the exact min, max, count and sum.
+
+    The histogram starts with bins of base_width and doubles the bin width (merging neighbouring bins) whenever a value falls past the end,
+    so it never needs to know the range up front. n_bins must be even so neighbouring bins pair up. Sketches with the same n_bins and base_width can be merged.
+
+    Non-finite values (nan or inf) can't be binned, so they are counted in non_finite and left out of everything else
+    '''
+    def __init__(self, n_bins = 1024, base_width = 0.01):
+        if n_bins < 2 or n_bins % 2:
+            raise ValueError(f"n_bins must be even and at least 2, not {n_bins}")
+        if not base_width > 0:
+            raise ValueError(f"base_width must be positive, not {base_width}")
+        self.n_bins = n_bins
+        self.base_width = base_width
+        self.width = base_width
+        self.counts = np.zeros(n_bins, dtype = np.int64)
+        self.count = 0
+        self.non_finite = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def _grow(self, value):
+        '''
+        Doubles the bin width until value fits inside the histogram
+        '''
+        if not np.isfinite(value):
+            raise ValueError(f"Can't fit {value} in the histogram")
+        while value >= self.n_bins * self.width:
+            merged = self.counts.reshape(-1, 2).sum(axis = 1)
+            self.counts = np.concatenate([merged, np.zeros(self.n_bins - len(merged), dtype = np.int64)])
+            self.width *= 2
+
+    def update(self, values):
+        values = np.asarray(values, dtype = np.float64).ravel()
+        finite = np.isfinite(values)
+        if not finite.all():
+            self.non_finite += int(values.size - finite.sum())
+            values = values[finite]
+        if values.size == 0:
+            return self
+        self._grow(values.max())
+        bins = np.minimum((values / self.width).astype(np.int64), self.n_bins - 1)
+        self.counts += np.bincount(bins, minlength = self.n_bins)
+        self.count += values.size
+        self.total += values.sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        return self
+
+    def merge(self, other):
+        '''
+        Adds another sketch's counts to this one. Raises a ValueError if the two sketches have different n_bins or base_width
+        '''
+        if (other.n_bins, other.base_width) != (self.n_bins, self.base_width):
+            raise ValueError(f"Can't merge a sketch with n_bins = {other.n_bins}, base_width = {other.base_width} "
+                             f"into one with n_bins = {self.n_bins}, base_width = {self.base_width}")
+        self.non_finite += other.non_finite
+        if other.count == 0:
+            return self
+        self._grow(other.max)
+        counts = other.counts
+        width = other.width
+        while width < self.width:
+            counts = np.concatenate([counts.reshape(-1, 2).sum(axis = 1), np.zeros(self.n_bins // 2, dtype = np.int64)])
+            width *= 2
+        self.counts = self.counts + counts
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        '''
+        Estimated quantile(s), interpolating linearly within the histogram bins and clipped to the exact min and max
+        '''
+        q = np.asarray(q, dtype = np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)
+        cumulative = np.concatenate([[0], np.cumsum(self.counts)])
+        edges = np.arange(self.n_bins + 1) * self.width
+        output = np.interp(q * self.count, cumulative, edges)
+        return np.clip(output, self.min, self.max)
+
+    def mean(self):
+        return self.total / self.count if self.count else np.nan
+
+    def box_stats(self, label):
+        '''
+        The statistics matplotlib's Axes.bxp needs to draw a boxplot, with whiskers at 1.5 times the interquartile range. Outliers aren't kept so none are drawn
+        '''
+        q1, med, q3 = self.quantile([0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        return {
+            "label": label,
+            "q1": q1,
+            "med": med,
+            "q3": q3,
+            "mean": self.mean(),
+            "whislo": max(self.min, q1 - 1.5 * iqr),
+            "whishi": min(self.max, q3 + 1.5 * iqr),
+            "fliers": []
+        }
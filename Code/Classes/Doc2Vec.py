@@ -1,29 +1,101 @@
 from gensim.models.doc2vec import Doc2Vec as D2V, TaggedDocument
+from joblib import Parallel, delayed
+from time import time
+import numpy as np
 import joblib
 import gc
+import os
+from Classes.Embeddings import save_embeddings
+from Classes.StageMetrics import measure
+
+
+@measure("Doc2Vec.train", items = lambda tagged_docs, *args, **kwargs: len(tagged_docs), info = lambda tagged_docs, dimensions, *args, **kwargs: dimensions)
+def _train_doc2vec(tagged_docs, dimensions, iterations, workers = 3, infer = False):
+    '''
+    Trains a single DBOW model and returns the document vectors along with the time taken.
+
+    The vectors come straight from model.dv unless infer is True, in which case every document is re-inferred as before
+    '''
+    start = time()
+    model = D2V(vector_size = int(dimensions), window = 4, epochs = iterations, dm = 0, workers = workers) ## DM = 0 for DBOW
+    model.build_vocab(tagged_docs)
+    model.train(tagged_docs, total_examples=model.corpus_count, epochs=model.epochs)
+    if infer:
+        document_embeddings = [model.infer_vector(doc.words) for doc in tagged_docs]
+    else:
+        ## Tags are the integers 0 to n-1, so the rows of model.dv are already in document order
+        document_embeddings = [i for i in np.array(model.dv.vectors[:len(tagged_docs)])]
+    del model
+    gc.collect()
+    return document_embeddings, time() - start
+
 
 class Doc2Vec():
     def __init__(self, input_df):
         self.data = input_df.drop_duplicates(subset = "text_index")
     
-    def tag_docs(self, stop_words = False):
-        if  stop_words:
-            self.documents_col = "text_preprocessed"
-        else:
-            self.documents_col = "text_no_stop"
-        self.tagged_docs = [TaggedDocument(words=doc.split(), tags=[i]) for i, doc in enumerate(self.data[self.documents_col])]
-
-    def document_encode(self, dimensions = 100, iterations = 1500):
+    def _documents_col(self, stop_words):
+        if stop_words:
+            return "text_preprocessed"
+        return "text_no_stop"
+
+    def _tag(self, stop_words, corpus = None):
+        '''
+        Tags each document with its position. The words come from the corpus if one is given, otherwise from splitting the text
+        '''
+        if corpus is not None:
+            corpus.check_alignment(self.data)
+            return [TaggedDocument(words=doc, tags=[i]) for i, doc in enumerate(corpus.documents(stop_words))]
+        return [TaggedDocument(words=doc.split(), tags=[i]) for i, doc in enumerate(self.data[self._documents_col(stop_words)])]
+
+    @measure("Doc2Vec.tag_docs", items = lambda self, *args, **kwargs: len(self.tagged_docs))
+    def tag_docs(self, stop_words = False, corpus = None):
+        self.documents_col = self._documents_col(stop_words)
+        self.tagged_docs = self._tag(stop_words, corpus)
+
+    def document_encode(self, dimensions = 100, iterations = 1500, infer = False, workers = 3):
+        '''
+        Trains a model with the given dimensions on the tagged documents. infer = True re-infers every document vector instead of reading them from the trained model
+        '''
         self.dimensions = dimensions
-        
-        model = D2V(vector_size = int(dimensions), window = 4, epochs = iterations, dm = 0) ## DM = 0 for DBOW
-        model.build_vocab(self.tagged_docs)
-        model.train(self.tagged_docs, total_examples=model.corpus_count, epochs=model.epochs)
-        self.document_embeddings = [model.infer_vector(doc.split()) for doc in self.data[self.documents_col]]
-        del model
-        gc.collect()
-    
-    def save_docs(self, directory, stop_words, name = None):
+        self.document_embeddings, _ = _train_doc2vec(self.tagged_docs, dimensions, iterations, workers = workers, infer = infer)
+
+    def train_configs(self, configs, iterations = 1500, processes = None, workers = None, infer = False, corpus = None):
+        '''
+        Trains several (dimensions, stop_words) configurations at once, each in its own process.
+
+        workers is the number of gensim threads each model gets, by default the cpu count split evenly between the processes. corpus is an optional shared Corpus to take the words from.
+        Returns a dictionary of {(dimensions, stop_words): {"embeddings": ..., "time": ...}}, which is also kept for save_configs
+        '''
+        if not processes:
+            processes = min(len(configs), os.cpu_count() or 1)
+        if not workers:
+            workers = max(1, (os.cpu_count() or 1) // processes)
+
+        tagged = {}
+        for _, stop_words in configs:
+            if stop_words not in tagged:
+                tagged[stop_words] = self._tag(stop_words, corpus)
+
+        outputs = Parallel(n_jobs = processes)(
+            delayed(_train_doc2vec)(tagged[stop_words], dimensions, iterations, workers = workers, infer = infer) for dimensions, stop_words in configs
+        )
+        self.config_embeddings = {config: {"embeddings": embeddings, "time": t} for config, (embeddings, t) in zip(configs, outputs)}
+        return self.config_embeddings
+
+    def save_configs(self, directory):
+        '''
+        Saves the embeddings from every configuration trained by train_configs
+        '''
+        for (dimensions, stop_words), output in self.config_embeddings.items():
+            self.dimensions = dimensions
+            self.document_embeddings = output["embeddings"]
+            self.save_docs(directory, stop_words)
+
+    def save_docs(self, directory, stop_words, name = None, fmt = "joblib"):
+        '''
+        Saves the document embeddings. fmt = "npy" saves a memory mappable .npy matrix with a .json metadata sidecar instead of the joblib list
+        '''
         stops = ""
         if not stop_words:
             stops = "_b"
@@ -32,6 +104,17 @@ class Doc2Vec():
         if not name.endswith(".joblib"):
             name = f"{name}.joblib"
 
+        if fmt == "npy":
+            metadata = {
+                "model": "Doc2Vec",
+                "type": self.dimensions,
+                "stop_words": "In" if stop_words else "Out",
+                "dimensions": int(self.dimensions),
+                "text_index": self.data["text_index"].tolist()
+            }
+            save_embeddings(self.document_embeddings, f'{directory}/{name}', metadata)
+            return
+
         with open(f'{directory}/{name}', 'wb') as file:
             joblib.dump(self.document_embeddings, file)
-            file.close()
\ No newline at end of file
+            file.close()
@@ -0,0 +1,63 @@
+import hashlib
+import os
+
+import joblib
+import numpy as np
+
+
+class EmbeddingCache():
+    '''
+    A persistent store of text embeddings keyed by model name, preprocessing variant and a hash of the text itself.
+
+    Each model/variant pair is held in its own joblib file so that only the texts that have changed since the last run need encoding.
+    '''
+    def __init__(self, directory, model, variant):
+        self.directory = directory
+        self.model = model
+        self.variant = variant
+        self.path = f"{directory}/{model.replace('/', '_')} - {variant}.joblib"
+        self.load()
+
+    @staticmethod
+    def text_hash(text):
+        '''
+        Content address of a text, the sha1 of its utf-8 encoding
+        '''
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def load(self):
+        '''
+        Loads the stored embeddings, starting an empty cache if there isn't one yet
+        '''
+        self.vectors = {}
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as file:
+                self.vectors = joblib.load(file)
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok = True)
+        with open(self.path, "wb") as file:
+            joblib.dump(self.vectors, file)
+
+    def missing(self, texts):
+        '''
+        Returns the unique texts that don't have a cached embedding yet
+        '''
+        seen = set()
+        output = []
+        for text in texts:
+            key = self.text_hash(text)
+            if key not in self.vectors and key not in seen:
+                seen.add(key)
+                output.append(text)
+        return output
+
+    def add(self, texts, embeddings):
+        for text, vector in zip(texts, embeddings):
+            self.vectors[self.text_hash(text)] = np.asarray(vector, dtype = np.float32)
+
+    def get(self, texts):
+        '''
+        Returns the cached embeddings for the texts as one contiguous float32 array, in the same order as the texts
+        '''
+        return np.ascontiguousarray(np.vstack([self.vectors[self.text_hash(text)] for text in texts]), dtype = np.float32)
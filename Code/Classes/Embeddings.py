@@ -1,15 +1,49 @@
 from sklearn.preprocessing import StandardScaler
+import numpy as np
+import json
+import os
 import re
 import joblib
 
+
+def list_embedding_files(directory):
+    '''
+    Lists the embedding files in a directory. Where a joblib file has been converted to .npy only the .npy version is listed
+    '''
+    files = os.listdir(directory)
+    converted = {i[:-len(".npy")] for i in files if i.endswith(".npy")}
+    return sorted(i for i in files if i.endswith(".npy") or (i.endswith(".joblib") and i[:-len(".joblib")] not in converted))
+
+def save_embeddings(embeddings, path, metadata):
+    '''
+    Saves embeddings as one contiguous float32 .npy matrix, with the metadata in a .json sidecar next to it.
+
+    metadata should hold the model, type, stop_words and dimensions, plus text_index, the text index of each row
+    '''
+    if path.endswith(".joblib"):
+        path = path[:-len(".joblib")]
+    if not path.endswith(".npy"):
+        path = f"{path}.npy"
+    matrix = np.ascontiguousarray(np.vstack(embeddings), dtype = np.float32)
+    np.save(path, matrix)
+    metadata = dict(metadata)
+    metadata["text_index"] = [int(i) for i in metadata.get("text_index", range(matrix.shape[0]))]
+    metadata["shape"] = list(matrix.shape)
+    with open(f"{path[:-len('.npy')]}.json", "w") as file:
+        json.dump(metadata, file)
+    return path
+
+
 class Embeddings():
     def __init__(self, path, name):
         self.path = path
+        self.scaled = False
         self._clean_name(name)
 
     def _clean_name(self,name):
         n = re.search(r'[^/]+$', self.path).group(0)
-        n = name.replace(".joblib","")
+        n = name.replace(".joblib","").replace(".npy","")
+        self.name = n
         if n[-2:] == "_b":
             n = n[0:-2]
             self.no_stop_words = True
@@ -18,9 +52,17 @@ class Embeddings():
         n = n.replace(" ", "").replace("dimensions", "")
         self.model, self.type = n.split("-", 1)
         
-    def load(self):
+    def load(self, mmap_mode = "r"):
+        '''
+        Loads the embeddings. .npy files are memory mapped with mmap_mode, joblib files are unpickled into memory as before
+        '''
         if hasattr(self, "data"):
             return
+        if self.path.endswith(".npy"):
+            self.data = np.load(self.path, mmap_mode = mmap_mode)
+            with open(f"{self.path[:-len('.npy')]}.json", "r") as file:
+                self.metadata = json.load(file)
+            return
         with open(self.path, "rb") as file:
             try:
                 embeddings = joblib.load(file)
@@ -30,7 +72,113 @@ class Embeddings():
             file.close()
 
         self.data = embeddings
+
+    def convert(self, text_index = None):
+        '''
+        One-off conversion of a joblib embedding file to the .npy format, returns the path of the new file
+        '''
+        self.load()
+        metadata = {
+            "model": self.model,
+            "type": self.type,
+            "stop_words": "Out" if self.no_stop_words else "In",
+            "dimensions": len(self.data[0])
+        }
+        if text_index is not None:
+            metadata["text_index"] = text_index
+        return save_embeddings(self.data, self.path, metadata)
     
-    def scale(self):
-        scaler = StandardScaler()
-        self.data = scaler.fit_transform(self.data)
\ No newline at end of file
+    def _scaler_path(self):
+        return f"{re.sub(r'[.](joblib|npy)$', '', self.path)}.scaler.npz"
+
+    def _fit_scaler(self, data, chunk_size = 10000):
+        '''
+        Works out the mean and standard deviation of each column in float64, a chunk of rows at a time so the full matrix is never copied.
+
+        Each chunk's mean and sum of squared deviations are combined with the running ones (Chan et al.'s parallel form of Welford's method),
+        which stays accurate for columns with a large mean where the sum of squares minus the squared mean would cancel
+        '''
+        count = 0
+        mean = np.zeros(data.shape[1])
+        squares = np.zeros(data.shape[1]) ## Sum of squared deviations from the mean
+        for start in range(0, data.shape[0], chunk_size):
+            chunk = np.asarray(data[start:start + chunk_size], dtype = np.float64)
+            chunk_mean = chunk.mean(axis = 0)
+            chunk_squares = ((chunk - chunk_mean) ** 2).sum(axis = 0)
+            delta = chunk_mean - mean
+            total = count + len(chunk)
+            mean += delta * len(chunk) / total
+            squares += chunk_squares + delta ** 2 * count * len(chunk) / total
+            count = total
+        scale = np.sqrt(squares / count)
+        scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0 ## Constant columns are left unscaled, as StandardScaler does
+        return mean, scale
+
+    def _source_stamp(self):
+        '''
+        Modification time and size of the embedding file, saved with the scaler so a regenerated file isn't scaled with old statistics
+        '''
+        stat = os.stat(self.path)
+        return np.array([stat.st_mtime_ns, stat.st_size], dtype = np.int64)
+
+    def _scaler_matches(self, scaler, data):
+        if "source" not in scaler or not np.array_equal(scaler["source"], self._source_stamp()):
+            return False
+        return data is None or tuple(scaler["shape"]) == (len(data), len(data[0]))
+
+    def prepare_scaler(self, data = None):
+        '''
+        Returns the cached scaler mean and scale, fitting and saving them first if there aren't any yet.
+        A saved scaler is refitted if the embedding file has changed since, or doesn't have the same number of rows and dimensions as data.
+
+        The file is written under a temporary name and moved into place, so a process reading it never sees it half written.
+        Call this once before sending jobs that share an embedding file to a pool, so they don't all fit it at the same time
+        '''
+        path = self._scaler_path()
+        if os.path.exists(path):
+            with np.load(path) as scaler:
+                if self._scaler_matches(scaler, data):
+                    return scaler["mean"], scaler["scale"]
+        if data is None:
+            self.load()
+            data = np.vstack(self.data, dtype = np.float32) if isinstance(self.data, list) else self.data
+        mean, scale = self._fit_scaler(data)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as file:
+            np.savez(file, mean = mean, scale = scale, shape = np.array(data.shape, dtype = np.int64), source = self._source_stamp())
+        os.replace(temp_path, path)
+        return mean, scale
+
+    def scale(self, cache = False):
+        '''
+        Standardises the embeddings. cache = True saves the scaler mean and scale next to the embedding file the first time, 
+        and every later call reuses them and scales a float32 copy of the data in place rather than refitting a StandardScaler.
+
+        Does nothing if the embeddings have already been scaled, as the cached mean and scale would otherwise be applied a second time
+        '''
+        if self.scaled:
+            return
+        if not cache:
+            scaler = StandardScaler()
+            self.data = scaler.fit_transform(self.data)
+            self.scaled = True
+            return
+
+        if isinstance(self.data, np.ndarray) and self.data.dtype == np.float32 and self.data.flags.writeable:
+            data = self.data
+        else:
+            ## One float32 copy, needed anyway as memory maps are read only. Lists are stacked straight into float32
+            data = np.vstack(self.data, dtype = np.float32) if isinstance(self.data, list) else np.array(self.data, dtype = np.float32)
+
+        mean, scale = self.prepare_scaler(data)
+        data -= mean.astype(np.float32)
+        data /= scale.astype(np.float32)
+        self.data = data
+        self.scaled = True
+
+if __name__ == "__main__":
+    ## Convert any joblib embeddings that don't have a .npy version yet
+    directory = "Data/Embeddings"
+    for i in list_embedding_files(directory):
+        if i.endswith(".joblib"):
+            print(Embeddings(f"{directory}/{i}", i).convert())
@@ -3,21 +3,111 @@ from collections import defaultdict
 
 import joblib
 import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
 from mittens import GloVe as GM
+from mittens.mittens_base import randmatrix
+from scipy import sparse
 from nltk.tokenize import word_tokenize
 from tqdm import tqdm
 
+from Classes.Embeddings import save_embeddings
+from Classes.StageMetrics import measure
+
+
+def _co_occurrence_chunk(token_ids, doc_lengths, window_size, vocab_size):
+    '''
+    Builds the sparse co-occurrence counts for one chunk of documents.
+
+    token_ids is a flat array of the vocab ids for every token in the chunk, doc_lengths holds the number of tokens in each document
+    '''
+    doc_lengths = np.asarray(doc_lengths, dtype=np.int64)
+    starts = np.repeat(np.cumsum(doc_lengths) - doc_lengths, doc_lengths)
+    lengths = np.repeat(doc_lengths, doc_lengths)
+    position = np.arange(len(token_ids)) - starts ## Position of each token within its own document
+    rows, cols, weights = [], [], []
+    for offset in range(-window_size, window_size + 1):
+        if offset == 0:
+            continue
+        j = position + offset
+        valid = (j >= 0) & (j < lengths)
+        i = np.flatnonzero(valid)
+        rows.append(token_ids[i])
+        cols.append(token_ids[i + offset])
+        # Same weighting as the dictionary version, 1/dist where dist is the distance from j to the end of the document
+        weights.append(1 / (lengths[i] - j[i]))
+    co_matrix = sparse.coo_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))), shape = (vocab_size, vocab_size))
+    return co_matrix.tocsr() ## Converting to csr sums the duplicate (row, col) entries
+
+
+class SparseGloVe():
+    '''
+    GloVe trained with full batch AdaGrad over only the non-zero entries of a sparse co-occurrence matrix.
+
+    Uses the same cost, initialisation and update rule as mittens, so memory and time scale with the number of non-zeros rather than vocab size squared
+    '''
+    def __init__(self, n = 100, xmax = 100, alpha = 0.75, max_iter = 100, learning_rate = 0.05, display_progress = 10):
+        self.n = n
+        self.xmax = xmax
+        self.alpha = alpha
+        self.max_iter = max_iter
+        self.learning_rate = learning_rate
+        self.display_progress = display_progress
+
+    def fit(self, X):
+        X = sparse.csr_matrix(X)
+        X.eliminate_zeros()
+        n_words = X.shape[0]
+        rows, cols = X.nonzero()
+        counts = np.asarray(X[rows, cols]).ravel()
+        weights = (np.minimum(counts, self.xmax) / float(self.xmax)) ** self.alpha
+        log_counts = np.log(counts)
+
+        W = randmatrix(n_words, self.n)
+        C = randmatrix(n_words, self.n)
+        bw = randmatrix(n_words, 1)
+        bc = randmatrix(n_words, 1)
+        ## AdaGrad accumulators, started at 0.1 as in mittens
+        momentum = {name: np.full_like(param, 0.1) for name, param in zip(["W", "C", "bw", "bc"], [W, C, bw, bc])}
+        self.errors = []
+        for iteration in range(self.max_iter):
+            diffs = np.einsum('ij,ij->i', W[rows], C[cols]) + bw[rows, 0] + bc[cols, 0] - log_counts
+            weighted_diffs = sparse.csr_matrix((weights * diffs, (rows, cols)), shape = X.shape)
+            gradients = {
+                "W": weighted_diffs.dot(C),
+                "C": weighted_diffs.T.dot(W),
+                "bw": np.asarray(weighted_diffs.sum(axis=1)).reshape(-1, 1),
+                "bc": np.asarray(weighted_diffs.sum(axis=0)).reshape(-1, 1)
+            }
+            for name, param in zip(["W", "C", "bw", "bc"], [W, C, bw, bc]):
+                momentum[name] += gradients[name] ** 2
+                param -= self.learning_rate * gradients[name] / np.sqrt(momentum[name])
+            self.errors.append((0.5 * weights * diffs ** 2).sum())
+            if self.display_progress and (iteration + 1) % self.display_progress == 0:
+                print(f"Iteration {iteration + 1}: error {self.errors[-1]:4.4f}")
+        return W + C
+
 
 class GloVe():
     def __init__(self, input_df):
         self.data = input_df.drop_duplicates(subset = "text_index")
+        self.corpus = None
 
-    def preprocess(self, stop_words = False):
+    @measure("GloVe.preprocess", items = lambda self, *args, **kwargs: len(self.data))
+    def preprocess(self, stop_words = False, corpus = None):
+        '''
+        Tokenises the documents. If a Corpus built from the same data is given its token ids are used instead, and nothing is tokenised here
+        '''
         if stop_words:
             self.documents_col = "text_preprocessed"
         else:
             self.documents_col = "text_no_stop"
-            
+        self.stop_words = stop_words
+        self.corpus = corpus
+        if corpus is not None:
+            corpus.check_alignment(self.data)
+            return self.data
+
         tqdm.pandas(desc = "Tokenising...")
         self.data.loc[:, "tokens"] = self.data[self.documents_col].progress_apply(word_tokenize) ## Will neeed to verify that this works, if not revert to with out the .loc
         return self.data
@@ -26,7 +116,7 @@ class GloVe():
         co_occurrence_matrix = defaultdict(lambda: defaultdict(int)) ## Create an empty nested default dict
         print("Learning co-occurrences...")
         # Iterate over the tokens in the dataset
-        for tokens in tqdm(self.data['tokens']):
+        for tokens in tqdm(self._tokens()):
             # Create a loop where i represents numbers from 0 to the total number of tokens
             for i in range(len(tokens)):
                 # Determine the range of neighboring tokens based on the window size
@@ -41,6 +131,40 @@ class GloVe():
         self.co_matrix = co_occurrence_matrix
         self.vocab = list(co_occurrence_matrix.keys())
 
+    def _sparse_co_matrix(self, window_size, n_jobs = 1, chunk_size = 1000):
+        '''
+        Vectorised version of _co_matrix. Maps the tokens to integer vocab ids and accumulates the counts into a scipy sparse matrix.
+
+        Documents are split into chunks of chunk_size, with n_jobs controlling how many processes the chunks are spread across
+        '''
+        print("Learning co-occurrences...")
+        # Single token documents have no neighbours, leaving them out keeps the vocab identical to the dictionary version
+        if self.corpus is not None:
+            corpus_ids, doc_lengths = self.corpus.view(self.stop_words)
+            keep = np.repeat(doc_lengths > 1, doc_lengths)
+            doc_lengths = doc_lengths[doc_lengths > 1].astype(np.int64)
+            # Renumber the corpus ids in order of first appearance, as factorising the words would
+            token_ids, vocab_ids = pd.factorize(corpus_ids[keep])
+            self.vocab = list(self.corpus.vocab[vocab_ids])
+        else:
+            tokens = [t for t in self.data['tokens'] if len(t) > 1]
+            doc_lengths = np.array([len(t) for t in tokens], dtype=np.int64)
+            token_ids, vocab = pd.factorize(pd.Series([token for t in tokens for token in t], dtype=object))
+            self.vocab = list(vocab)
+
+        bounds = np.cumsum(doc_lengths)
+        chunks = []
+        for start in range(0, len(doc_lengths), chunk_size):
+            stop = min(start + chunk_size, len(doc_lengths))
+            first = bounds[start - 1] if start else 0
+            chunks.append((token_ids[first:bounds[stop - 1]], doc_lengths[start:stop]))
+
+        partials = Parallel(n_jobs = n_jobs)(delayed(_co_occurrence_chunk)(ids, lengths, window_size, len(self.vocab)) for ids, lengths in tqdm(chunks))
+        co_matrix = sparse.csr_matrix((len(self.vocab), len(self.vocab)))
+        for partial in partials:
+            co_matrix += partial
+        self.co_matrix = co_matrix
+
     def _mat_to_array(self, vocab):
            # Create a NumPy array of zeros with dimensions based on the original matrix
         array = np.zeros((len(vocab), len(vocab)))
@@ -54,40 +178,116 @@ class GloVe():
         pb.close()
         self.co_matrix = array
 
-    def make_co_matrix(self, window_size = 4):
-        self._co_matrix(window_size)
-        self._mat_to_array(self.vocab)
+    @measure("GloVe.make_co_matrix", items = lambda self, *args, **kwargs: len(self.vocab))
+    def make_co_matrix(self, window_size = 4, vectorised = False, n_jobs = 1, dense = True):
+        '''
+        Builds the co-occurrence array used to fit the model. vectorised = True uses the sparse builder, n_jobs sets the number of processes it uses
+
+        dense = False keeps the vectorised matrix sparse, for use with the sparse backend in run_GloVe
+        '''
+        if vectorised:
+            self._sparse_co_matrix(window_size, n_jobs = n_jobs)
+            if dense:
+                self.co_matrix = self.co_matrix.toarray()
+        else:
+            self._co_matrix(window_size)
+            self._mat_to_array(self.vocab)
 
-    def run_GloVe(self, dimensions = '100', iterations = 1500):
+    @measure("GloVe.run_GloVe", items = lambda self, *args, **kwargs: len(self.vocab), info = lambda self, *args, **kwargs: self.dimensions)
+    def run_GloVe(self, dimensions = '100', iterations = 1500, backend = "mittens"):
+        '''
+        Fits the GloVe model. backend = "sparse" trains on the non-zero co-occurrences only instead of passing the dense array to mittens
+        '''
         self.dimensions = dimensions
         ## Train GloVe model
-        model = GM(n = int(dimensions), max_iter = iterations, display_progress=500)
+        if backend == "sparse":
+            model = SparseGloVe(n = int(dimensions), max_iter = iterations, display_progress=500)
+        elif sparse.issparse(self.co_matrix):
+            raise ValueError("The mittens backend needs a dense co-occurrence matrix, use make_co_matrix(dense = True) or backend = 'sparse'")
+        else:
+            model = GM(n = int(dimensions), max_iter = iterations, display_progress=500)
         print("Fitting GloVe model...")
         embeddings = model.fit(self.co_matrix)
-        ## Convert to dictionary
+        ## Keep the matrix for document encoding and convert to dictionary
+        self.embedding_matrix = embeddings
         self.embeddings = {word: vector for word, vector in zip(self.vocab, embeddings)}
         del model
         gc.collect()
 
-    def document_encode(self, documents = None):
+    def _tokens(self):
+        '''
+        The training documents' token lists, taken from the corpus if there is one
+        '''
+        if self.corpus is not None:
+            return self.corpus.documents(self.stop_words)
+        return self.data['tokens']
+
+    def _document_tokens(self, documents):
+        """
+        Returns the token lists for a DataFrame of documents, tokenising them first if there is no tokens column
+        """
+        if "tokens" in documents:
+            return documents["tokens"]
+        return documents[self.documents_col].apply(word_tokenize)
+
+    @measure("GloVe.document_encode", items = lambda self, *args, **kwargs: len(self.document_embeddings), info = lambda self, *args, **kwargs: self.dimensions)
+    def document_encode(self, documents = None, batch_size = 10000):
         """
         Encode the provided documents or defaults to training data if none provided.
+
+        documents can be any DataFrame with a tokens column (or the text column used in training), so new releases can be embedded without retraining.
+        Each document vector is the mean of its token vectors, with out of vocabulary tokens counted as zeros, calculated as a sparse doc-term x embedding matrix product one batch at a time.
         """
-        if not documents:
+        embedding_matrix = np.asarray(self.embedding_matrix)
+        if documents is None and self.corpus is not None:
+            document_matrix = self._corpus_encode(embedding_matrix, batch_size)
+            self.document_embeddings = [i for i in document_matrix]
+            return document_matrix
+        if documents is None:
             documents = self.data
-        # Determine the dimension of the embeddings
-        embedding_dim = len(list(self.embeddings.items())[0][1])
-        self.document_embeddings = [] # Empty list to hold embeddings
-        for _, row in (documents.iterrows()):
-            tokens = row["tokens"]
-            # Get the GloVe embeddings for each token and handle missing tokens with zero-filled arrays
-            embeddings = [self.embeddings.get(token, np.zeros(embedding_dim)) for token in tokens]
-            # Calculate the average embedding for the document
-            avg_embedding = np.mean(embeddings, axis=0)
-            # Append the document embedding to the list
-            self.document_embeddings.append(avg_embedding)
-
-    def save_docs(self, directory, stop_words, name = None):
+        tokens = self._document_tokens(documents)
+        # Map every word in the vocab to its row of the embedding matrix
+        word_ids = pd.Index(self.vocab)
+
+        batches = []
+        for start in range(0, len(tokens), batch_size):
+            batch = tokens.iloc[start:start + batch_size]
+            doc_lengths = batch.str.len().to_numpy()
+            token_ids = word_ids.get_indexer([token for t in batch for token in t])
+            doc_ids = np.repeat(np.arange(len(batch)), doc_lengths)
+            known = token_ids >= 0
+            doc_term = sparse.csr_matrix((np.ones(known.sum()), (doc_ids[known], token_ids[known])), shape = (len(batch), len(self.vocab)))
+            batches.append(doc_term.dot(embedding_matrix) / np.maximum(doc_lengths, 1)[:, np.newaxis])
+
+        document_matrix = np.vstack(batches) if batches else np.empty((0, embedding_matrix.shape[1]))
+        self.document_embeddings = [i for i in document_matrix]
+        return document_matrix
+
+    def _corpus_encode(self, embedding_matrix, batch_size):
+        '''
+        document_encode for the training documents straight from the corpus token ids, without going through the words
+        '''
+        corpus_ids, doc_lengths = self.corpus.view(self.stop_words)
+        ## Row of the embedding matrix for each corpus vocab id, -1 for words the model never saw
+        rows = np.full(len(self.corpus.vocab), -1, dtype = np.int64)
+        rows[pd.Index(self.corpus.vocab).get_indexer(self.vocab)] = np.arange(len(self.vocab))
+        token_rows = rows[corpus_ids]
+        bounds = np.concatenate([[0], np.cumsum(doc_lengths)])
+
+        batches = []
+        for start in range(0, len(doc_lengths), batch_size):
+            stop = min(start + batch_size, len(doc_lengths))
+            batch_rows = token_rows[bounds[start]:bounds[stop]]
+            doc_ids = np.repeat(np.arange(stop - start), doc_lengths[start:stop])
+            known = batch_rows >= 0
+            doc_term = sparse.csr_matrix((np.ones(known.sum()), (doc_ids[known], batch_rows[known])), shape = (stop - start, len(self.vocab)))
+            batches.append(doc_term.dot(embedding_matrix) / np.maximum(doc_lengths[start:stop], 1)[:, np.newaxis])
+        return np.vstack(batches) if batches else np.empty((0, embedding_matrix.shape[1]))
+
+    def save_docs(self, directory, stop_words, name = None, fmt = "joblib"):
+        '''
+        Saves the document embeddings. fmt = "npy" saves a memory mappable .npy matrix with a .json metadata sidecar instead of the joblib list
+        '''
         stops = ""
         if not stop_words:
             stops = "_b"
@@ -96,6 +296,17 @@ class GloVe():
         if not name.endswith(".joblib"):
             name = f"{name}.joblib"
 
+        if fmt == "npy":
+            metadata = {
+                "model": "GloVe",
+                "type": self.dimensions,
+                "stop_words": "In" if stop_words else "Out",
+                "dimensions": int(self.dimensions),
+                "text_index": self.data["text_index"].tolist()
+            }
+            save_embeddings(self.document_embeddings, f'{directory}/{name}', metadata)
+            return
+
         with open(f'{directory}/{name}', 'wb') as file:
             joblib.dump(self.document_embeddings, file)
             file.close()
@@ -2,29 +2,120 @@ import pandas as pd
 import re
 import numpy as np
 from tqdm import tqdm
+from joblib import Parallel, delayed, effective_n_jobs
+from time import perf_counter
+import tracemalloc
+import hashlib
+import joblib
 import os
+from Classes.StageMetrics import measure
+
+try:
+    import pyarrow ## Only needed for parquet snapshots, pickle is used without it
+    SNAPSHOT_FORMAT = "parquet"
+except ImportError:
+    SNAPSHOT_FORMAT = "pkl"
+## Part of every snapshot's name, bump it whenever a change to the refine steps changes their output so old snapshots aren't used
+SNAPSHOT_VERSION = 2
+
+## The only columns of the articles csv that get used, and the types to read them as
+COLUMN_TYPES = {
+    "versionid": "category",
+    "root_num": "int64",
+    "current_num": str,
+    "text": str
+}
+
+
+def _parse_versions(versionid):
+    '''
+    Converts the versionid column to datetimes. For the categorical column from HCSOs.load only the categories are parsed
+    '''
+    if isinstance(versionid.dtype, pd.CategoricalDtype):
+        dates = pd.to_datetime(versionid.cat.categories)
+        codes = versionid.cat.codes.to_numpy()
+        ## Missing versionids have code -1, which take would read as the last category
+        output = pd.Series(dates.take(np.maximum(codes, 0)), index = versionid.index)
+        output[codes < 0] = pd.NaT
+        return output
+    return pd.to_datetime(versionid)
+
+
+def _remove_stopwords_chunk(texts, stop_words):
+    '''
+    Removes stop words from a chunk of texts, used to spread the work across processes
+    '''
+    return [' '.join(word for word in text.split() if word not in stop_words) for text in texts]
 
 
 class HCSOs():
     '''
     A class designed to hold the HCSOs data set and perform dataframe operations that are specific to it.
     '''
-    def __init__(self, data_location, version_name = None):
+    def __init__(self, data_location, version_name = None, snapshot_dir = None, load = True, refine_fast = False):
         '''
         Initialise the class using the location of the data directory holding the csv file and the name of HCSOs csv to be loaded
+
+        snapshot_dir is where refined copies of the data are kept, keyed by the hash of the csv, the refine path and SNAPSHOT_VERSION. If one matches
+        it is loaded in place of the csv and refine_data does nothing, otherwise refine_data saves one there for next time.
+        refine_fast is the refine path the data will be refined with, so the right snapshot can be found when loading
         '''
         if not version_name:
             try:
-                version_name = [i for i in os.listdir(data_location).sorted(ascending=False) if i.endswith("_articles.csv")][0]
+                version_name = sorted([i for i in os.listdir(data_location) if i.endswith("_articles.csv")], reverse = True)[0]
             except:
                 version_name = "parlrules_ukhoc_3.0.1_articles"
+        self.data_location = data_location
+        self.version_name = version_name
+        self.snapshot_dir = snapshot_dir
+        self.refined = False
+        self.refine_fast = refine_fast
+        self._hash = None
+        if load:
+            self.load()
+
+    def _csv_path(self):
+        path = f"{self.data_location}/{self.version_name}"
+        return path if path.endswith(".csv") else f"{path}.csv"
+
+    def _snapshot_path(self):
+        stem = os.path.basename(self._csv_path())[:-len(".csv")]
+        path = "fast" if self.refine_fast else "full"
+        return f"{self.snapshot_dir}/{stem}_{self._source_hash()[:16]}_{path}_v{SNAPSHOT_VERSION}.{SNAPSHOT_FORMAT}"
+
+    @measure("HCSOs.load", items = lambda self, *args, **kwargs: len(self.data), info = lambda self, *args, **kwargs: "snapshot" if self.refined else "csv")
+    def load(self):
+        '''
+        Loads the data, from a snapshot of the refined data if there is one for this csv, otherwise from the csv itself.
+
+        Only the columns in COLUMN_TYPES are read. versionid is read as an ordered categorical, so its dates are only parsed once per version
+        '''
+        if self.snapshot_dir and os.path.exists(self._snapshot_path()):
+            if SNAPSHOT_FORMAT == "parquet":
+                self.data = pd.read_parquet(self._snapshot_path())
+            else:
+                self.data = pd.read_pickle(self._snapshot_path())
+            self.refined = True
+            return
+        data = pd.read_csv(self._csv_path(), usecols = list(COLUMN_TYPES), dtype = COLUMN_TYPES)
+        data['versionid'] = data['versionid'].cat.set_categories(sorted(data['versionid'].cat.categories), ordered = True)
+        data['current_num'] = data['current_num'].fillna('') ## Blank article numbers would otherwise come through as NaN
+        self.data = data[list(COLUMN_TYPES)]
+        self.refined = False
+
+    def _save_snapshot(self):
+        os.makedirs(self.snapshot_dir, exist_ok = True)
+        if SNAPSHOT_FORMAT == "parquet":
+            self.data.to_parquet(self._snapshot_path(), index = False)
+        else:
+            self.data.to_pickle(self._snapshot_path())
 
     def _trim_cols(self, input_df):
         '''
         We won't be using all the columns, this just gets rid of them
         '''
         data = input_df.copy()
-        output = data.drop(['chamberid', 'releaseid', 'articleid'], axis=1)
+        output = data.drop(['chamberid', 'releaseid', 'articleid'], axis=1, errors='ignore')
         return(output)                            
     
     def _version_to_date(self, input_df):
@@ -33,7 +124,7 @@ class HCSOs():
         '''
         data = input_df.copy()
         output = data.copy()
-        output['publication_date'] = pd.to_datetime(data['versionid'])
+        output['publication_date'] = _parse_versions(data['versionid'])
         return output
     
     def _better_article_number(self, input_df):
@@ -63,16 +154,78 @@ class HCSOs():
         output.drop("text_lower", axis = 1, inplace = True)
         return output
     
-    def refine_data(self):
+    def _refine_fast(self, input_df):
+        '''
+        Single pass version of the four functions above, giving the same output without their intermediate copies.
+
+        The article number and letter come from vectorised string operations, and text_index from pd.factorize on the lower cased text,
+        which numbers the distinct texts in order of first appearance just as the drop_duplicates and merge did
         '''
-        This runs all of the above commands
+        data = input_df.drop(['chamberid', 'releaseid', 'articleid'], axis=1, errors='ignore') ## The only full copy before the sort
+        data['publication_date'] = _parse_versions(data['versionid'])
+        current_num = data['current_num'].fillna('').astype(str)
+        # All the digits, or all the letters, joined together as the filter lambdas did
+        digits = current_num.str.replace(r'\D', '', regex = True)
+        data['article_number'] = pd.to_numeric(digits.where(digits != ''), errors = 'coerce') ## int64 unless some are missing, as with apply
+        letters = current_num.str.replace(r'[\W\d_]', '', regex = True)
+        data['article_letter'] = letters.where(current_num.str.contains(r'[a-zA-Z]', regex = True), np.nan)
+        # Arrange by 'publication_date' first and then by 'article_number' and 'article_letter'
+        output = data.sort_values(['publication_date', 'article_number', 'article_letter'], ascending = [True, True, True], ignore_index = True)
+        output['text_index'], _ = pd.factorize(output['text'].str.lower(), use_na_sentinel = False)
+        return output
+
+    @measure("HCSOs.refine_data", items = lambda self, *args, **kwargs: len(self.data))
+    def refine_data(self, fast = None):
         '''
-        df = self.data.copy()
-        df = self._trim_cols(df)
-        df = self._version_to_date(df)
-        df = self._better_article_number(df)
-        df = self._add_text_index(df)
-        self.data = df
+        This runs all of the above commands. fast = True runs the single pass _refine_fast instead, and defaults to the refine_fast the object was made with.
+
+        Does nothing if the data came from a snapshot for the same refine path, and saves a snapshot if there is a snapshot_dir
+        '''
+        fast = self.refine_fast if fast is None else fast
+        if fast != self.refine_fast:
+            ## The data was loaded for the other refine path, so look for this path's snapshot, or start again from the csv if it was already refined
+            self.refine_fast = fast
+            if self.refined or (self.snapshot_dir and os.path.exists(self._snapshot_path())):
+                self.load()
+        if self.refined:
+            return
+        if fast:
+            self.data = self._refine_fast(self.data)
+        else:
+            df = self.data.copy()
+            df = self._trim_cols(df)
+            df = self._version_to_date(df)
+            df = self._better_article_number(df)
+            df = self._add_text_index(df)
+            self.data = df
+        self.refined = True
+        if self.snapshot_dir:
+            self._save_snapshot()
+
+    def compare_refine(self):
+        '''
+        Runs both refine paths on the unrefined data and prints the time and peak traced memory of each, and whether their outputs match
+        '''
+        original = self.data
+        snapshot_dir, refine_fast = self.snapshot_dir, self.refine_fast
+        self.snapshot_dir = None
+        report = {}
+        outputs = {}
+        for name, fast in [("current", False), ("fast", True)]:
+            tracemalloc.start()
+            start = perf_counter()
+            self.refine_data(fast = fast)
+            report[f"{name}_time"] = perf_counter() - start
+            report[f"{name}_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+            outputs[name] = self.data
+            self.data = original
+            self.refined = False
+        self.snapshot_dir, self.refine_fast = snapshot_dir, refine_fast
+        report["identical"] = outputs["current"].equals(outputs["fast"])
+        for key, value in report.items():
+            print(f"{key}: {value}")
+        return report
 
     def show_cols(self):
         '''
@@ -112,20 +265,84 @@ class HCSOs():
         filtered_words = [word for word in words if word not in stop_words]
         return ' '.join(filtered_words)
     
-    def preprocess(self, patterns = ["\(i+\)","\([a-z]\)","\[newline\]"], stop_words = None):
+    def _source_hash(self):
+        '''
+        Hash of the source csv, or of the text column if the csv can't be found
+        '''
+        if self._hash:
+            return self._hash
+        path = self._csv_path()
+        digest = hashlib.sha1()
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                for block in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(block)
+        else:
+            digest.update(pd.util.hash_pandas_object(self.data['text'], index = False).to_numpy().tobytes())
+            return digest.hexdigest()
+        self._hash = digest.hexdigest()
+        return self._hash
+
+    def _preprocess_cache_path(self, cache_dir, patterns, stop_words, fast):
+        '''
+        Cache file for a combination of source data, row order, patterns, stop word set and preprocessing path
+        '''
+        key = hashlib.sha1()
+        key.update(self._source_hash().encode())
+        key.update(np.ascontiguousarray(self.data['text_index'].to_numpy(), dtype = np.int64).tobytes())
+        key.update(repr(list(patterns)).encode())
+        key.update(repr(sorted(stop_words) if stop_words else None).encode())
+        key.update(repr(bool(fast)).encode())
+        return f"{cache_dir}/preprocessed_{key.hexdigest()[:16]}.joblib"
+
+    @measure("HCSOs.preprocess", items = lambda self, *args, **kwargs: len(self.processed))
+    def preprocess(self, patterns = ["\(i+\)","\([a-z]\)","\[newline\]"], stop_words = None, fast = False, n_jobs = 1, cache_dir = None):
         '''
         Preprocess the text data. Uses the dataframe stored in the class object as the data source.
 
         patterns refers to any patterns that should be removed from the text, this defaults to the minimal approach I have chosen to take
         
         stop_words is the stop word dictionary to use. defaults to none, this way it will only remove stop words if they are provided.
+
+        fast = True removes every pattern in one pass of a single compiled alternation with Series.str.replace, and filters stop words in chunks over n_jobs processes.
+        This gives the same output as the default as long as no pattern can match across a space, which holds for the defaults.
+        cache_dir saves the processed columns there, keyed by the source data, row order, patterns, stop words and fast, so repeat runs skip preprocessing entirely.
         '''
         self.processed = self.data.copy()
-        tqdm.pandas(desc = "Removing unwanted patterns")
-        self.processed['text_preprocessed'] = self.processed['text'].progress_apply(lambda x: self._remove_junk(x, patterns))
-        if stop_words:
-            tqdm.pandas(desc = "Removing stop words")
-            self.processed['text_no_stop'] = self.processed['text_preprocessed'].progress_apply(lambda x: self._remove_stopwords(x, stop_words))
+        if cache_dir:
+            cache_path = self._preprocess_cache_path(cache_dir, patterns, stop_words, fast)
+            if os.path.exists(cache_path):
+                with open(cache_path, "rb") as file:
+                    cached = joblib.load(file)
+                ## The cached columns are put back by position, so only use them if the rows are in the same order
+                if np.array_equal(cached.pop('text_index', None), self.processed['text_index'].to_numpy()):
+                    for col, values in cached.items():
+                        self.processed[col] = values
+                    return
+
+        if fast:
+            junk = re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+            self.processed['text_preprocessed'] = self.processed['text'].str.replace(junk, " ", regex = True)
+            if stop_words:
+                texts = self.processed['text_preprocessed'].tolist()
+                ## effective_n_jobs turns n_jobs = -1 and the like into the actual number of workers
+                chunk_size = max(1, -(-len(texts) // (effective_n_jobs(n_jobs) * 4)))
+                chunks = Parallel(n_jobs = n_jobs)(delayed(_remove_stopwords_chunk)(texts[i:i + chunk_size], stop_words) for i in range(0, len(texts), chunk_size))
+                self.processed['text_no_stop'] = [text for chunk in chunks for text in chunk]
+        else:
+            tqdm.pandas(desc = "Removing unwanted patterns")
+            self.processed['text_preprocessed'] = self.processed['text'].progress_apply(lambda x: self._remove_junk(x, patterns))
+            if stop_words:
+                tqdm.pandas(desc = "Removing stop words")
+                self.processed['text_no_stop'] = self.processed['text_preprocessed'].progress_apply(lambda x: self._remove_stopwords(x, stop_words))
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok = True)
+            cols = [col for col in ['text_preprocessed', 'text_no_stop'] if col in self.processed]
+            cached = {col: self.processed[col].tolist() for col in cols}
+            cached['text_index'] = self.processed['text_index'].to_numpy()
+            with open(cache_path, "wb") as file:
+                joblib.dump(cached, file)
 
     def add_version_id(self):
         versions = self.data[['versionid']].drop_duplicates()
@@ -1,12 +1,66 @@
 import sqlite3
+import numpy as np
 import pandas as pd
+from contextlib import contextmanager
 from sqlite3 import Error
 
 
 class Results():
-    def __init__(self, path):
+    def __init__(self, path, wal = False, busy_timeout = None):
+        """
+        wal = True switches the database to write-ahead logging so readers and a writer can work at the same time,
+        busy_timeout (in ms) makes a connection wait for a lock instead of failing with "database is locked"
+        """
         self.path = path
         self.con = sqlite3.connect(self.path)
+        self._pending = None
+        if busy_timeout:
+            self.con.execute(f"PRAGMA busy_timeout = {int(busy_timeout)}")
+        if wal:
+            self.con.execute("PRAGMA journal_mode = WAL")
+
+    def _write(self, statements):
+        """
+        Runs a list of (sql, parameters) writes and commits them, or queues them if inside a batch
+        """
+        if self._pending is not None:
+            self._pending.extend(statements)
+            return
+        c = self.con.cursor()
+        for sql, params in statements:
+            c.execute(sql, params)
+        self.con.commit()
+
+    @contextmanager
+    def batch(self):
+        """
+        Collects every write made inside the with block and flushes them in one transaction when it ends,
+        with one executemany per run of consecutive identical statements, so every write happens in the order it was made. Nothing is written if the block raises an exception.
+
+        Example:
+            with results.batch():
+                for row in rows:
+                    results.add_training_time(row)
+        """
+        if self._pending is not None: ## Already batching, the outer batch will flush
+            yield self
+            return
+        self._pending = []
+        try:
+            yield self
+            pending = self._pending
+        finally:
+            self._pending = None
+        runs = []
+        for sql, params in pending:
+            if runs and runs[-1][0] == sql:
+                runs[-1][1].append(params)
+            else:
+                runs.append((sql, [params]))
+        with self.con:
+            c = self.con.cursor()
+            for sql, params in runs:
+                c.executemany(sql, params)
 
     def get_table(self,tab):
         
@@ -44,29 +98,31 @@ class Results():
                 stop_words TEXT NOT NULL,
                 dimensions INTEGER,
                 time FLOAT,
+                started TEXT,
+                finished TEXT,
                 PRIMARY KEY (model, type, stop_words)
             )
             ''')
             self.con.commit()
         except Error as e:
             print(e)
+        ## Databases made before the start and finish times were recorded need the columns adding
+        for col in ["started", "finished"]:
+            if col not in self.list_table_columns("training_times"):
+                c.execute(f"ALTER TABLE training_times ADD COLUMN {col} TEXT")
+        self.con.commit()
 
         
     def add_training_time(self,row):
         """
-        Insert or update the training_times table with the provided row.
+        Insert or update the training_times table with the provided row. started and finished are optional
         """
-        c = self.con.cursor()
-        
         # Upsert (insert or replace) the data
-        c.execute('''
+        self._write([('''
         INSERT OR REPLACE INTO training_times 
-        (model, type, stop_words, dimensions, time)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (row["model"], row["type"], row["stop_words"], row["dimensions"], row["time"]))
-        
-        # Commit the changes and close the connection
-        self.con.commit()
+        (model, type, stop_words, dimensions, time, started, finished)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (row["model"], row["type"], row["stop_words"], row["dimensions"], row["time"], row.get("started"), row.get("finished")))])
 
     def create_kmeans_times(self):
         """
@@ -95,22 +151,145 @@ class Results():
         """
         Update or insert a time in the 'kmeans_times' table 
         """
+        self._write([
+            ## Create the row if it doesn't exist, ignore it if it does
+            (f'''
+            INSERT OR IGNORE INTO kmeans_times (model_name, model_type, {experiment_name})
+            VALUES (?, ?, ?)
+            ''', (model_name, model_type, time)),
+            ## Update the row to put the time in the appropriate column
+            (f'''
+            UPDATE kmeans_times
+            SET {experiment_name} = ?
+            WHERE model_name = ? AND model_type = ?
+            ''', (time, model_name, model_type))
+        ])
+
+    def create_benchmark_tab(self):
+        """
+        Create the 'kmeans_benchmark' table, one row per clustering strategy for each model and experiment
+        """
         c = self.con.cursor()
+        try:
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS kmeans_benchmark (
+                    model TEXT,
+                    type TEXT,
+                    experiment TEXT,
+                    strategy TEXT,
+                    time FLOAT,
+                    inertia FLOAT,
+                    accuracy FLOAT,
+                    warm_source TEXT,
+                    PRIMARY KEY(model, type, experiment, strategy)
+                )
+            ''')
+            self.con.commit()
+        except Error as e:
+            print(e)
+        ## Tables made before warm start sources were recorded need the column adding
+        if "warm_source" not in self.list_table_columns("kmeans_benchmark"):
+            c.execute("ALTER TABLE kmeans_benchmark ADD COLUMN warm_source TEXT")
+            self.con.commit()
 
-        ## Create the row if it doesn't exist, ignore it if it does
-        c.execute(f'''
-        INSERT OR IGNORE INTO kmeans_times (model_name, model_type, {experiment_name})
-        VALUES (?, ?, ?)
-        ''', (model_name, model_type, time))
-        
-        ## Update the row to put the time in the appropriate column
-        c.execute(f'''
-        UPDATE kmeans_times
-        SET {experiment_name} = ?
-        WHERE model_name = ? AND model_type = ?
-        ''', (time, model_name, model_type))
-        
-        self.con.commit()
+    def add_benchmark(self, row):
+        """
+        Insert or update the kmeans_benchmark table with the provided row.
+        """
+        self._write([('''
+        INSERT OR REPLACE INTO kmeans_benchmark
+        (model, type, experiment, strategy, time, inertia, accuracy, warm_source)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (row["model"], row["type"], row["experiment"], row["strategy"], row["time"], row["inertia"], row["accuracy"], row.get("warm_source")))])
+
+    def create_label_tab(self):
+        """
+        Create the 'cluster_labels' table, a register of the .npy label array saved for each run.
+        The true root numbers for an experiment are registered under the model name 'root_num'.
+        """
+        c = self.con.cursor()
+        try:
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS cluster_labels (
+                    model TEXT,
+                    type TEXT,
+                    experiment TEXT,
+                    path TEXT NOT NULL,
+                    n_rows INTEGER,
+                    PRIMARY KEY(model, type, experiment)
+                )
+            ''')
+            self.con.commit()
+        except Error as e:
+            print(e)
+
+    def register_labels(self, model_name, model_type, experiment_name, path, n_rows):
+        """
+        Insert or update the location of a run's label array
+        """
+        self._write([('''
+        INSERT OR REPLACE INTO cluster_labels (model, type, experiment, path, n_rows)
+        VALUES (?, ?, ?, ?, ?)
+        ''', (model_name, model_type, experiment_name, path, int(n_rows)))])
+
+    def load_labels(self, experiment_name):
+        """
+        Bulk loads every registered run for an experiment.
+
+        Returns:
+        - y_true (np.ndarray): the root numbers, or None if they haven't been registered
+        - runs (list): the (model, type) of each run
+        - labels (np.ndarray): 2-D integer array with one row of labels per run
+        """
+        c = self.con.cursor()
+        c.execute('''
+        SELECT model, type, path FROM cluster_labels
+        WHERE experiment = ?
+        ORDER BY model, type
+        ''', (experiment_name,))
+        y_true = None
+        runs = []
+        arrays = []
+        for model_name, model_type, path in c.fetchall():
+            if model_name == "root_num":
+                y_true = np.load(path).astype(np.int64)
+                continue
+            runs.append((model_name, model_type))
+            arrays.append(np.load(path))
+        labels = np.vstack(arrays).astype(np.int64) if arrays else np.empty((0, 0), dtype = np.int64)
+        return y_true, runs, labels
+
+    def create_stage_tab(self):
+        """
+        Create the 'stage_metrics' table, one row for each time a measured stage runs (see Classes/StageMetrics.py)
+        """
+        c = self.con.cursor()
+        try:
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS stage_metrics (
+                    stage TEXT NOT NULL,
+                    info TEXT,
+                    started TEXT,
+                    wall_time FLOAT,
+                    cpu_time FLOAT,
+                    peak_rss_mb FLOAT,
+                    items INTEGER,
+                    pid INTEGER,
+                    failed INTEGER
+                )
+            ''')
+            self.con.commit()
+        except Error as e:
+            print(e)
+
+    def add_stage_metrics(self, row):
+        """
+        Record one measured stage in the 'stage_metrics' table
+        """
+        self._write([('''
+            INSERT INTO stage_metrics (stage, info, started, wall_time, cpu_time, peak_rss_mb, items, pid, failed)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (row["stage"], row["info"], row["started"], row["wall_time"], row["cpu_time"], row["peak_rss_mb"], row["items"], row["pid"], int(row["failed"])))])
 
     def list_table_columns(self, table_name):
         """
@@ -168,22 +347,19 @@ class Results():
         """
         Update or insert a into a result table 
         """
-        c = self.con.cursor()
-
-        ## Create the row if it doesn't exist, ignore it if it does
-        c.execute(f'''
-        INSERT OR IGNORE INTO {table} (model, type, {experiment_name})
-        VALUES (?, ?, ?)
-        ''', (model_name, model_type, result))
-        
-        ## Update the row to put the time in the appropriate column
-        c.execute(f'''
-        UPDATE {table}
-        SET {experiment_name} = ?
-        WHERE model = ? AND type = ?
-        ''', (result, model_name, model_type))
-        
-        self.con.commit()
+        self._write([
+            ## Create the row if it doesn't exist, ignore it if it does
+            (f'''
+            INSERT OR IGNORE INTO {table} (model, type, {experiment_name})
+            VALUES (?, ?, ?)
+            ''', (model_name, model_type, result)),
+            ## Update the row to put the time in the appropriate column
+            (f'''
+            UPDATE {table}
+            SET {experiment_name} = ?
+            WHERE model = ? AND type = ?
+            ''', (result, model_name, model_type))
+        ])
     
     def drop_tab(self, table_name):
         c = self.con.cursor()
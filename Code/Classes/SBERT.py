@@ -3,32 +3,80 @@ from tqdm import tqdm
 import numpy as np
 import joblib 
 import gc
+from Classes.EmbeddingCache import EmbeddingCache
+from Classes.Embeddings import save_embeddings
+from Classes.StageMetrics import measure
 
 class SBERT():
     def __init__(self, input_df):
         self.data = input_df.drop_duplicates(subset = "text_index")
         self.pb_length = self.data.shape[0]
 
-    def document_encode(self, model, stop_words):
+    def _encode_batches(self, model, texts, batch_size):
+        """
+        Encodes the texts in batches of batch_size, updating the progress bar as each batch finishes
+        """
+        batches = []
+        progress_bar = tqdm(total=len(texts), desc = "Encoding Documents")
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            batches.append(model.encode(batch, batch_size = batch_size, convert_to_numpy = True))
+            progress_bar.update(len(batch))
+        progress_bar.close()
+        return batches
+
+    def _encode(self, model, texts, batch_size, processes):
+        """
+        Encodes a list of texts, returning a float32 array in the same order as the texts.
+
+        Texts are sorted by length before being batched so that each batch needs as little padding as possible, then put back in their original order.
+        processes > 1 spreads chunks of the texts over a pool of that many CPU worker processes instead of encoding them in this one.
+        """
+        ## Word counts are a cheap stand in for token counts when ordering by length
+        order = np.argsort([len(text.split()) for text in texts], kind = "stable")
+        sorted_texts = [texts[i] for i in order]
+
+        if processes and processes > 1:
+            pool = model.start_multi_process_pool(target_devices = ["cpu"] * processes)
+            try:
+                encoded = model.encode_multi_process(sorted_texts, pool, batch_size = batch_size)
+            finally:
+                model.stop_multi_process_pool(pool)
+        else:
+            encoded = np.vstack(self._encode_batches(model, sorted_texts, batch_size))
+
+        ## Put the embeddings back in the same order as the documents
+        output = np.empty(encoded.shape, dtype = np.float32)
+        output[order] = encoded
+        return output
+
+    @measure("SBERT.document_encode", items = lambda self, *args, **kwargs: len(self.document_embeddings), info = lambda self, *args, **kwargs: self.model)
+    def document_encode(self, model, stop_words, batch_size = 32, processes = None, cache_dir = None):
+        """
+        Encodes the documents with the named sentence transformer model.
+
+        If cache_dir is given, embeddings are looked up in an EmbeddingCache stored there and only texts that haven't been seen before with this model and preprocessing are encoded.
+        """
         self.model = model
         if stop_words:
             self.documents_col = "text_preprocessed"
         else:
             self.documents_col = "text_no_stop"
-        model = SentenceTransformer(self.model)
-        document_embeddings = []
-        progress_bar = tqdm(total=self.pb_length, desc = "Encoding Documents")
-        for text in self.data[self.documents_col]:
-            # Encode each document
-            encoded_text = model.encode([text])[0]
-            document_embeddings.append(encoded_text)
-
-            # Update the progress bar
-            progress_bar.update(1)
-
-        # Close the progress bar
-        progress_bar.close()
-        self.document_embeddings = [i for i in np.array(document_embeddings)]
+        texts = self.data[self.documents_col].tolist()
+
+        model = None
+        if cache_dir:
+            cache = EmbeddingCache(cache_dir, self.model, self.documents_col)
+            new_texts = cache.missing(texts)
+            print(f"{len(texts) - len(new_texts)} of {len(texts)} documents found in the cache")
+            if new_texts:
+                model = SentenceTransformer(self.model)
+                cache.add(new_texts, self._encode(model, new_texts, batch_size, processes))
+                cache.save()
+            self.document_embeddings = cache.get(texts)
+        else:
+            model = SentenceTransformer(self.model)
+            self.document_embeddings = self._encode(model, texts, batch_size, processes)
         try:
             self.dimensions = len(self.document_embeddings[0])
         except: ## Seems to be working fine, get rid of this bit later
@@ -41,9 +89,9 @@ class SBERT():
         del model
         gc.collect()
 
-    def save_docs(self, directory, tag,  name = None):
+    def save_docs(self, directory, tag,  name = None, fmt = "joblib"):
         """
-        saves the document embeddings, fairly self explanatory
+        saves the document embeddings, fairly self explanatory. fmt = "npy" saves a memory mappable .npy matrix with a .json metadata sidecar instead
         """
 
         if not name:
@@ -51,6 +99,17 @@ class SBERT():
         if not name.endswith(".joblib"):
             name = f"{name}.joblib"
 
+        if fmt == "npy":
+            metadata = {
+                "model": "SBERT",
+                "type": self.model,
+                "stop_words": "Out" if tag == "_b" else "In",
+                "dimensions": self.dimensions,
+                "text_index": self.data["text_index"].tolist()
+            }
+            save_embeddings(self.document_embeddings, f'{directory}/{name}', metadata)
+            return
+
         with open(f'{directory}/{name}', 'wb') as file:
             joblib.dump(self.document_embeddings, file)
             file.close()
\ No newline at end of file
@@ -0,0 +1,216 @@
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from time import perf_counter, process_time
+import os
+import sqlite3
+import warnings
+
+try:
+    import resource
+except ImportError: ## Not available on Windows, where peak memory and child cpu time aren't recorded
+    resource = None
+
+## Set by enable() and inherited by worker processes, so stages measured in a pool are written to the same database in the same way
+DATABASE_VARIABLE = "STAGE_METRICS_DB"
+WAL_VARIABLE = "STAGE_METRICS_WAL"
+BUSY_TIMEOUT_VARIABLE = "STAGE_METRICS_BUSY_TIMEOUT"
+
+_stack = [] ## Stages currently open in this process, innermost last
+_records = [] ## Stages measured while no database is enabled, or that couldn't be written to it
+_results = None ## This process's own connection to the database
+_results_key = None ## The path, settings and pid _results was opened with. A forked worker mustn't use the connection it inherited from its parent
+_batched = None ## Rows held back by batch() until its with block ends
+
+
+def enable(path, wal = False, busy_timeout = None):
+    '''
+    Writes every stage measured from now on, in this process and any it starts, to the stage_metrics table of the results database at path.
+
+    wal and busy_timeout are passed on to Results. WAL mode stays on the database file once set, so it is only used when asked for
+    '''
+    os.environ[DATABASE_VARIABLE] = path
+    os.environ[WAL_VARIABLE] = "1" if wal else ""
+    os.environ[BUSY_TIMEOUT_VARIABLE] = str(int(busy_timeout)) if busy_timeout else ""
+
+
+def collected():
+    '''
+    The stages measured in this process while no database was enabled, or that failed to be written to it, as a list of dictionaries
+    '''
+    return list(_records)
+
+
+def _peak_rss():
+    '''
+    High water mark of this process's resident memory in MB. On Linux this is since the last _reset_peak, elsewhere it is since the process started
+    '''
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if os.uname().sysname == "Darwin" else peak / 1024 ## Bytes on macOS, KB on Linux
+
+
+def _reset_peak():
+    '''
+    Resets the Linux memory high water mark so each stage gets its own peak. Does nothing where this isn't possible
+    '''
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def _children_cpu():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _connection(path):
+    global _results, _results_key
+    wal = bool(os.environ.get(WAL_VARIABLE))
+    busy_timeout = int(os.environ.get(BUSY_TIMEOUT_VARIABLE) or 0) or None
+    key = (path, wal, busy_timeout, os.getpid())
+    if _results is None or _results_key != key:
+        from Classes.Results import Results
+        results = Results(path, wal = wal, busy_timeout = busy_timeout)
+        results.create_stage_tab()
+        _results, _results_key = results, key
+    return _results
+
+
+def _save(rows):
+    '''
+    Writes rows to the database in one transaction. A database error is only warned about and the rows are kept in _records,
+    so the metrics can never fail the code being measured
+    '''
+    path = os.environ.get(DATABASE_VARIABLE)
+    if not path:
+        _records.extend(rows)
+        return
+    try:
+        results = _connection(path)
+        with results.batch():
+            for row in rows:
+                results.add_stage_metrics(row)
+    except sqlite3.Error as e:
+        warnings.warn(f"Couldn't write {len(rows)} stage metrics rows to {path}, kept in memory instead: {e}")
+        _records.extend(rows)
+
+
+def _write(row):
+    if _batched is not None and os.environ.get(DATABASE_VARIABLE):
+        _batched.append(row)
+    else:
+        _save([row])
+
+
+@contextmanager
+def batch():
+    '''
+    Holds back the stages measured inside the with block and writes them in one transaction when it ends, so a stage measured on every pass
+    of a loop doesn't commit once per pass. The rows are still written if the block raises, so failed stages are recorded
+    '''
+    global _batched
+    if _batched is not None: ## Already batching, the outer batch will write them
+        yield
+        return
+    _batched = []
+    try:
+        yield
+    finally:
+        rows, _batched = _batched, None
+        if rows:
+            _save(rows)
+
+
+class Stage():
+    '''
+    Context manager measuring the wall time, cpu time, peak resident memory and number of items processed for one named stage.
+
+    cpu time includes any child processes that finished during the stage. Stages can be nested, each outer stage's peak memory covers its inner ones.
+
+    Example:
+        with Stage("GloVe.co_matrix", items = len(documents)) as stage:
+            ...
+            stage.info = f"{len(vocab)} words"
+    '''
+    def __init__(self, name, items = None, info = None):
+        self.name = name
+        self.items = items
+        self.info = info
+        self.peak = 0.0
+
+    def __enter__(self):
+        if _stack:
+            _stack[-1].peak = max(_stack[-1].peak, _peak_rss() or 0.0)
+        _reset_peak()
+        _stack.append(self)
+        self.started = datetime.now().isoformat(timespec = "seconds")
+        self._wall = perf_counter()
+        self._cpu = process_time() + _children_cpu()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = perf_counter() - self._wall
+        cpu = process_time() + _children_cpu() - self._cpu
+        _stack.pop()
+        peak = _peak_rss()
+        self.peak = max(self.peak, peak) if peak is not None else None
+        if _stack and self.peak is not None:
+            _stack[-1].peak = max(_stack[-1].peak, self.peak)
+        _write({
+            "stage": self.name,
+            "info": None if self.info is None else str(self.info),
+            "started": self.started,
+            "wall_time": wall,
+            "cpu_time": cpu,
+            "peak_rss_mb": self.peak,
+            "items": None if self.items is None else int(self.items),
+            "pid": os.getpid(),
+            "failed": exc_type is not None
+        })
+        return False
+
+
+def _describe(function, args, kwargs, convert):
+    '''
+    Calls an items or info function and converts its result, giving None rather than raising if either fails so the measurement can never break the measured call
+    '''
+    if function is None:
+        return None
+    try:
+        value = function(*args, **kwargs)
+        return None if value is None else convert(value)
+    except Exception:
+        return None
+
+
+def measure(name, items = None, info = None):
+    '''
+    Decorator that runs the function inside a Stage.
+
+    items and info are optional functions of the same arguments as the decorated function, called once it has finished so that
+    for a method they can count what it has just loaded or made, e.g. items = lambda self, *args, **kwargs: len(self.data).
+    If either raises, None is recorded in its place
+    '''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with Stage(name) as stage:
+                output = function(*args, **kwargs)
+                stage.items = _describe(items, args, kwargs, int)
+                stage.info = _describe(info, args, kwargs, str)
+            return output
+        return wrapper
+    return decorator
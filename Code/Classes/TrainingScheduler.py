@@ -0,0 +1,100 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from time import time
+import os
+
+from threadpoolctl import threadpool_limits
+
+
+def _total_memory_gb():
+    '''
+    Physical memory of the machine in GB, None if it can't be found
+    '''
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1e9
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _run_task(function, args, threads):
+    '''
+    Runs one task in a worker process with its BLAS/OpenMP threads capped, returning its output along with when it started and finished
+    '''
+    with threadpool_limits(limits = threads):
+        started = datetime.now()
+        start = time()
+        output = function(*args, threads = threads)
+        seconds = time() - start
+    return output, started.isoformat(timespec = "seconds"), datetime.now().isoformat(timespec = "seconds"), seconds
+
+
+class Task():
+    '''
+    One independent piece of work for the TrainingScheduler.
+
+    function is called as function(*args, threads = threads) in a worker process, so both must be picklable. threads and memory_gb are the
+    task's share of the machine, and no two tasks with the same exclusive group run at the same time
+    '''
+    def __init__(self, name, function, args = (), threads = 1, memory_gb = 0, exclusive = None, info = None):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.threads = threads
+        self.memory_gb = memory_gb
+        self.exclusive = exclusive
+        self.info = info if info else {}
+
+
+class TrainingScheduler():
+    '''
+    Runs a list of Tasks concurrently in a process pool without going over a thread or memory budget.
+
+    Tasks are started in the order they were added whenever they fit alongside the ones already running, so putting the longest tasks first
+    lets the short ones fill in the spare cores around them. A task that is bigger than the whole budget is run on its own
+    '''
+    def __init__(self, threads = None, memory_gb = None):
+        self.threads = threads if threads else (os.cpu_count() or 1)
+        self.memory_gb = memory_gb if memory_gb else _total_memory_gb()
+        self.tasks = []
+
+    def add(self, task):
+        self.tasks.append(task)
+
+    def _fits(self, task, running):
+        if not running:
+            return True
+        if sum(r.threads for r in running) + task.threads > self.threads:
+            return False
+        if self.memory_gb and sum(r.memory_gb for r in running) + task.memory_gb > self.memory_gb:
+            return False
+        return not (task.exclusive and any(r.exclusive == task.exclusive for r in running))
+
+    def run(self, on_finish):
+        '''
+        Runs every task, calling on_finish(task, output, started, finished, seconds) in this process as each one completes.
+
+        A task that raises is reported and skipped without stopping the others. Returns the names of any tasks that failed
+        '''
+        pending = list(self.tasks)
+        running = {}
+        failed = []
+        with ProcessPoolExecutor(max_workers = max(1, min(self.threads, len(pending)))) as pool:
+            while pending or running:
+                for task in list(pending):
+                    if self._fits(task, list(running.values())):
+                        print(f"Starting {task.name} at {datetime.now().strftime('%H:%M:%S')}")
+                        running[pool.submit(_run_task, task.function, task.args, task.threads)] = task
+                        pending.remove(task)
+                done, _ = wait(running, return_when = FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        output, started, finished, seconds = future.result()
+                    except Exception as e:
+                        print(f"{task.name} failed: {e}")
+                        failed.append(task.name)
+                        continue
+                    print(f"Finished {task.name} in {seconds:.0f}s")
+                    on_finish(task, output, started, finished, seconds)
+        self.tasks = []
+        return failed
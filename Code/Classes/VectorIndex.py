@@ -0,0 +1,168 @@
+from sklearn.cluster import KMeans
+import numpy as np
+import json
+
+
+class VectorIndex():
+    '''
+    A nearest neighbour index over a set of Embeddings, for looking up the articles closest to a vector across any range of versions.
+
+    backend = "exact" is a brute force search over every article. backend = "ivf" clusters the vectors into n_lists inverted lists with k-means
+    and only searches the n_probe lists with the nearest centroids, trading a little recall for speed. Both use euclidean distance.
+    '''
+    def __init__(self, embeddings, articles, backend = "exact", n_lists = None, n_probe = 8):
+        '''
+        embeddings is a loaded Embeddings object, articles is the HCSOs data with text_index and version_num columns
+        '''
+        self.embeddings = embeddings
+        self.backend = backend
+        self.n_probe = n_probe
+        self.vectors = self._as_array(embeddings.data)
+        self.n_lists = n_lists if n_lists else max(1, int(np.sqrt(self.vectors.shape[0])))
+        self._versions(articles)
+
+    @staticmethod
+    def _as_array(data):
+        return np.ascontiguousarray(np.vstack(data) if isinstance(data, list) else data, dtype = np.float32)
+
+    def _versions(self, articles):
+        '''
+        Builds a text x version table recording which versions each text appears in
+        '''
+        pairs = articles[["text_index", "version_num"]].drop_duplicates()
+        self.version_nums = np.sort(pairs["version_num"].unique())
+        self.membership = np.zeros((self.vectors.shape[0], len(self.version_nums)), dtype = bool)
+        self.membership[pairs["text_index"].to_numpy(), np.searchsorted(self.version_nums, pairs["version_num"].to_numpy())] = True
+
+    def build(self, random_state = 42):
+        self.norms = (self.vectors.astype(np.float64) ** 2).sum(axis = 1)
+        if self.backend == "ivf":
+            kmeans = KMeans(n_clusters = self.n_lists, n_init = 1, random_state = random_state)
+            self.lists = kmeans.fit_predict(self.vectors)
+            self.centroids = kmeans.cluster_centers_.astype(np.float32)
+            self._build_lists()
+        elif self.backend != "exact":
+            raise ValueError(f"Unknown backend: {self.backend}")
+        return self
+
+    def _build_lists(self):
+        '''
+        Stores the members of each inverted list together, so list l is list_ids[list_offsets[l]:list_offsets[l + 1]] in ascending order
+        '''
+        self.list_ids = np.argsort(self.lists, kind = "stable")
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(self.lists, minlength = self.n_lists))])
+
+    def _allowed(self, versions):
+        '''
+        Boolean mask of the texts that appear in any version from versions[0] to versions[1] inclusive
+        '''
+        if versions is None:
+            return np.ones(self.vectors.shape[0], dtype = bool)
+        first, last = versions
+        cols = (self.version_nums >= first) & (self.version_nums <= last)
+        return self.membership[:, cols].any(axis = 1)
+
+    def _candidates(self, query, allowed, backend):
+        if backend == "exact":
+            return np.flatnonzero(allowed)
+        centroid_distances = ((self.centroids - query) ** 2).sum(axis = 1)
+        probe = np.argsort(centroid_distances)[:self.n_probe]
+        ## Only the probed lists are read, sorted so ties are broken the same way as the exact search
+        candidates = np.sort(np.concatenate([self.list_ids[self.list_offsets[l]:self.list_offsets[l + 1]] for l in probe]))
+        return candidates[allowed[candidates]]
+
+    def search(self, queries, k = 10, versions = None, backend = None):
+        '''
+        Returns the text indexes of the k nearest articles to each query vector and their distances, both shaped (queries, k).
+
+        versions = (X, Y) limits the results to texts that appear somewhere in versions X to Y. Rows with fewer than k candidates are padded with -1 and inf
+        '''
+        backend = backend if backend else self.backend
+        queries = np.atleast_2d(np.asarray(queries, dtype = np.float32))
+        allowed = self._allowed(versions)
+        text_index = np.full((queries.shape[0], k), -1, dtype = np.int64)
+        distances = np.full((queries.shape[0], k), np.inf)
+        for q, query in enumerate(queries):
+            candidates = self._candidates(query, allowed, backend)
+            if len(candidates) == 0:
+                continue
+            ## Squared distances from the precomputed norms, one matrix-vector product per query
+            d = self.norms[candidates] - 2 * self.vectors[candidates].dot(query).astype(np.float64) + float(query.astype(np.float64).dot(query))
+            n = min(k, len(candidates))
+            best = np.argpartition(d, n - 1)[:n]
+            best = best[np.argsort(d[best], kind = "stable")]
+            text_index[q, :n] = candidates[best]
+            distances[q, :n] = np.sqrt(np.maximum(d[best], 0))
+        return text_index, distances
+
+    def recall(self, queries, k = 10, versions = None):
+        '''
+        Share of the exact k nearest neighbours that the index's own backend also returns
+        '''
+        exact, _ = self.search(queries, k, versions, backend = "exact")
+        found, _ = self.search(queries, k, versions)
+        hits = sum(len(np.intersect1d(e[e >= 0], f[f >= 0])) for e, f in zip(exact, found))
+        return hits / max((exact >= 0).sum(), 1)
+
+    def save(self, path):
+        '''
+        Saves everything except the vectors themselves, which are read back from the Embeddings when the index is loaded
+        '''
+        arrays = {"version_nums": self.version_nums, "membership": self.membership, "norms": self.norms}
+        if self.backend == "ivf":
+            arrays["lists"] = self.lists
+            arrays["centroids"] = self.centroids
+        np.savez(path, **arrays)
+        with open(f"{path}.json", "w") as file:
+            json.dump({"backend": self.backend, "n_lists": self.n_lists, "n_probe": self.n_probe, "embeddings": self.embeddings.path,
+                       "rows": self.vectors.shape[0], "dimensions": self.vectors.shape[1]}, file)
+
+    @classmethod
+    def load(cls, path, embeddings):
+        '''
+        Loads a saved index for embeddings, raising a ValueError if it was built from embeddings with a different shape or different vectors
+        '''
+        with open(f"{path}.json", "r") as file:
+            settings = json.load(file)
+        index = cls.__new__(cls)
+        index.embeddings = embeddings
+        index.backend = settings["backend"]
+        index.n_lists = settings["n_lists"]
+        index.n_probe = settings["n_probe"]
+        index.vectors = cls._as_array(embeddings.data)
+        with np.load(path if path.endswith(".npz") else f"{path}.npz") as arrays:
+            for key in arrays.files:
+                setattr(index, key, arrays[key])
+        index._check(settings)
+        if index.backend == "ivf":
+            index._build_lists()
+        return index
+
+    def _check(self, settings):
+        rows, dimensions = self.vectors.shape
+        if settings.get("rows", rows) != rows or settings.get("dimensions", dimensions) != dimensions:
+            raise ValueError(f"The index was built for {settings['rows']} x {settings['dimensions']} embeddings, not {rows} x {dimensions}")
+        if self.norms.shape[0] != rows or self.membership.shape[0] != rows:
+            raise ValueError(f"The index has {self.norms.shape[0]} rows but the embeddings have {rows}")
+        if self.backend == "ivf" and (self.lists.shape[0] != rows or self.centroids.shape[1] != dimensions):
+            raise ValueError("The index's inverted lists don't match the shape of the embeddings")
+        if not np.allclose(self.norms, (self.vectors.astype(np.float64) ** 2).sum(axis = 1)):
+            raise ValueError("The index was built from different embeddings")
+
+if __name__ == "__main__":
+    from Classes.Embeddings import Embeddings
+    from Classes.HCSOs import HCSOs
+
+    ## Build an approximate index for one set of embeddings and report its recall against the exact search
+    name = "SBERT - all-mpnet-base-v2.joblib"
+    embeddings = Embeddings(f"Data/Embeddings/{name}", name)
+    embeddings.load()
+    embeddings.scale(cache = True)
+    hcso = HCSOs("Data", "parlrules_ukhoc_3.0.1_articles.csv", snapshot_dir = "Data/cache", refine_fast = True)
+    hcso.refine_data(fast = True)
+    hcso.add_version_id()
+
+    index = VectorIndex(embeddings, hcso.data, backend = "ivf").build()
+    index.save(f"Data/Embeddings/{embeddings.name}.ivf")
+    sample = np.random.default_rng(42).choice(index.vectors.shape[0], size = 200, replace = False)
+    print(f"Recall@10: {index.recall(index.vectors[sample], k = 10):.3f}")
@@ -1,49 +1,83 @@
 from Classes.HCSOs import HCSOs
 from Classes.Embeddings import Embeddings
-from sklearn.metrics.pairwise import euclidean_distances
+from Classes.StageMetrics import measure, batch
+from scipy.spatial.distance import cdist
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
 
-def match_articles(model = "SBERT - all-mpnet-base-v2.joblib"):
+def _version_rows(hcso):
+    '''
+    Maps each version number to the positions of its rows in hcso.data
+    '''
+    versions = hcso.data["version_num"].to_numpy()
+    order = np.argsort(versions, kind = "stable")
+    values, starts = np.unique(versions[order], return_index = True)
+    return {v: rows for v, rows in zip(values, np.split(order, starts[1:]))}
 
-    article_vectors = Embeddings(f"Data/Embeddings/{model}",model)
-    article_vectors.load()
-    article_vectors.scale()
-
-    hcso = HCSOs("Data", "parlrules_ukhoc_3.0.1_articles.csv")
-    hcso.refine_data()
-    hcso.add_version_id()
-
-    results_data = []
-    pb = tqdm(total = 253310, desc = "Matching Documents") ## haven't done the maths to get the total yet, just run it without one the first time and copy in the final number of iterations for subsequent tries
-    for _i , row_i in hcso.unique_text_ids(full = True).iterrows():
+@measure("2b.nearest_predecessors", items = lambda vectors, query_index, *args, **kwargs: len(query_index))
+def nearest_predecessors(vectors, query_index, candidate_index, top_k = 1, block_size = 2048):
+    '''
+    Finds the top_k nearest candidates for each query, working through the queries in blocks so only one block of the distance matrix is held at a time.
 
-        vec_i = article_vectors.data[row_i["text_index"]].reshape(1, -1)
+    Returns the positions of the matches within candidate_index and their euclidean distances, both shaped (queries, top_k) and sorted nearest first
+    '''
+    top_k = min(top_k, len(candidate_index))
+    candidates = vectors[candidate_index]
+    positions = np.empty((len(query_index), top_k), dtype = np.int64)
+    distances = np.empty((len(query_index), top_k))
+    for start in range(0, len(query_index), block_size):
+        block = cdist(vectors[query_index[start:start + block_size]], candidates)
+        if top_k == 1:
+            best = block.argmin(axis = 1)[:, np.newaxis] ## argmin keeps the first candidate on ties, as the original loop did
+        else:
+            best = np.argpartition(block, top_k - 1, axis = 1)[:, :top_k]
+            best = np.take_along_axis(best, np.argsort(np.take_along_axis(block, best, axis = 1), axis = 1, kind = "stable"), axis = 1)
+        positions[start:start + block_size] = best
+        distances[start:start + block_size] = np.take_along_axis(block, best, axis = 1)
+    return positions, distances
 
-        match_sim_val  = np.inf  
-        match_sim_text_index = None
-        match_sim_root = None
+@measure("2b.match_articles", info = lambda model = "SBERT - all-mpnet-base-v2.joblib", *args, **kwargs: model)
+def match_articles(model = "SBERT - all-mpnet-base-v2.joblib", top_k = 1, block_size = 2048):
+    '''
+    Matches every unique article to its most similar article in the previous version of the Standing Orders.
 
-        version = hcso.data.query(f'version_num == {row_i["version_num"] - 1}')
-
-        for _ii, row_ii in version.iterrows():
+    top_k > 1 returns the k best predecessors for each article instead, with a rank column counting from 1
+    '''
+    article_vectors = Embeddings(f"Data/Embeddings/{model}",model)
+    article_vectors.load()
+    article_vectors.scale(cache = True)
+    vectors = np.vstack(article_vectors.data) if isinstance(article_vectors.data, list) else np.asarray(article_vectors.data)
 
-            vec_ii = article_vectors.data[row_ii["text_index"]].reshape(1, -1)
+    hcso = HCSOs("Data", "parlrules_ukhoc_3.0.1_articles.csv", snapshot_dir = "Data/cache", refine_fast = True)
+    hcso.refine_data(fast = True)
+    hcso.add_version_id()
 
-            e = euclidean_distances(vec_i, vec_ii)[0][0]
+    unique = hcso.unique_text_ids(full = True)
+    version_rows = _version_rows(hcso)
+    all_text_index = hcso.data["text_index"].to_numpy()
+    all_roots = hcso.data["root_num"].to_numpy()
 
-            if e < match_sim_val:
-                    match_sim_val  = e
-                    match_sim_text_index = row_ii["text_index"]
-                    match_sim_root = row_ii["root_num"]
-            pb.update(1)
-            
-        results_data.append([row_i["text_index"], row_i["root_num"], match_sim_text_index, match_sim_root, match_sim_val])
+    results_data = []
+    with batch(): ## The stage metrics of every nearest_predecessors call are written together once the loop ends
+        for v, queries in tqdm(unique.groupby("version_num", sort = False), desc = "Matching Documents"):
+            rows = version_rows.get(v - 1)
+            if rows is None:
+                ## Nothing to compare against in the first version
+                for order, text_index, root in zip(queries.index, queries["text_index"], queries["root_num"]):
+                    results_data.append([order, 1, text_index, root, None, None, np.inf])
+                continue
+            positions, distances = nearest_predecessors(vectors, queries["text_index"].to_numpy(), all_text_index[rows], top_k = top_k, block_size = block_size)
+            for q, (order, text_index, root) in enumerate(zip(queries.index, queries["text_index"], queries["root_num"])):
+                for rank in range(positions.shape[1]):
+                    match = rows[positions[q, rank]]
+                    results_data.append([order, rank + 1, text_index, root, all_text_index[match], all_roots[match], distances[q, rank]])
 
-    results = pd.DataFrame(results_data, columns=['text_index', 'text_root', 'match_index', 'match_root', 'match_sim'])
-    pb.close()
-    
+    results = pd.DataFrame(results_data, columns=['order', 'rank', 'text_index', 'text_root', 'match_index', 'match_root', 'match_sim'])
+    results = results.sort_values(['order', 'rank'], kind = "stable").reset_index(drop = True)
+    results = results[['text_index', 'text_root', 'match_index', 'match_root', 'match_sim', 'rank']]
+    if top_k == 1:
+        results = results.drop('rank', axis = 1)
     return results
 
 def match_rate(results):